@@ -0,0 +1,178 @@
+"""Локальная замена Telegram Bot API для проверки бота под нагрузкой.
+
+Запуск:  python bench/fake_api.py --port 8081 --flood 0.05
+Бот:     API_URL=http://127.0.0.1:8081 BOT_TOKEN=test python bot.py
+
+POST /files — загрузить файл (тело запроса), в ответ file_id для сообщения с документом.
+POST /inject — положить апдейты (список сообщений {"chat": {"id": ...}, "text": ...})
+в очередь, которую бот заберёт через getUpdates.
+GET /stats — сколько сообщений принято, сколько отбито 429/500 и сколько раз
+бот превысил лимиты Telegram (30 сообщений/с всего, 1 сообщение/с в чат).
+"""
+import time
+import random
+import asyncio
+import argparse
+from itertools import islice
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.0, flood=0.0, errors=0.0, retry_after=1):
+        self.latency = latency          # секунд на каждый запрос
+        self.flood = flood              # доля запросов, получающих 429
+        self.errors = errors            # доля запросов, получающих 500
+        self.retry_after = retry_after
+        self.sent = []                  # (время, chat_id, text)
+        self.stats = defaultdict(int)
+        self.recent = deque()           # время отправок за последнюю секунду — для проверки общего лимита
+        self.last_in_chat = {}          # chat_id -> время последнего сообщения
+        self.updates = deque()          # апдейты для getUpdates
+        self.next_update_id = 1
+        self.new_updates = asyncio.Event()
+        self.files = {}                 # file_id -> содержимое (getFile и sendDocument)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "multipart/form-data":
+            params = {}
+            async for part in await request.multipart():
+                if part.filename:
+                    params[part.name] = (part.filename, await part.read())
+                else:
+                    params[part.name] = await part.text()
+        else:
+            params = await request.json() if request.can_read_body else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            return web.json_response({"ok": False, "error_code": 404, "description": "Not Found"}, status=404)
+        return await handler(params)
+
+    async def api_sendMessage(self, params):
+        roll = random.random()
+        if roll < self.flood:
+            self.stats["429"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        if roll < self.flood + self.errors:
+            self.stats["500"] += 1
+            return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"},
+                                     status=500)
+
+        now = time.monotonic()
+        chat_id = params.get("chat_id")
+        self.recent.append(now)
+        while self.recent and now - self.recent[0] > 1:
+            self.recent.popleft()
+        if len(self.recent) > 30:
+            self.stats["global_limit_exceeded"] += 1
+        last = self.last_in_chat.get(chat_id)
+        if last is not None and now - last < 1:
+            self.stats["chat_limit_exceeded"] += 1
+        self.last_in_chat[chat_id] = now
+
+        self.stats["sent"] += 1
+        self.sent.append((now, chat_id, params.get("text", "")))
+        return web.json_response({"ok": True, "result": {
+            "message_id": self.stats["sent"], "chat": {"id": chat_id}, "text": params.get("text", ""),
+        }})
+
+    async def api_sendDocument(self, params):
+        filename, content = params.get("document", ("", b""))
+        file_id = f"doc{len(self.files) + 1}"
+        self.files[file_id] = content
+        self.stats["documents"] += 1
+        self.stats["document_bytes"] += len(content)
+        return web.json_response({"ok": True, "result": {
+            "chat": {"id": params.get("chat_id")},
+            "document": {"file_id": file_id, "file_name": filename, "file_size": len(content)},
+        }})
+
+    async def api_getFile(self, params):
+        file_id = params.get("file_id")
+        if file_id not in self.files:
+            return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"})
+        return web.json_response({"ok": True, "result": {
+            "file_id": file_id, "file_size": len(self.files[file_id]), "file_path": f"documents/{file_id}",
+        }})
+
+    async def get_file(self, request):
+        content = self.files.get(request.match_info["path"].rsplit("/", 1)[-1])
+        if content is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=content)
+
+    async def post_file(self, request):
+        file_id = f"up{len(self.files) + 1}"
+        self.files[file_id] = await request.read()
+        return web.json_response({"ok": True, "file_id": file_id, "file_size": len(self.files[file_id])})
+
+    def inject(self, messages):
+        for message in messages:
+            message.setdefault("date", int(time.time()))
+            self.updates.append({"update_id": self.next_update_id, "message": message})
+            self.next_update_id += 1
+        self.new_updates.set()
+
+    async def api_getUpdates(self, params):
+        offset = params.get("offset", 0)
+        limit = params.get("limit", 100)
+        # Подтверждённые (update_id < offset) больше не отдаём
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), params.get("timeout", 0))
+            except asyncio.TimeoutError:
+                pass
+        self.stats["getUpdates"] += 1
+        return web.json_response({"ok": True, "result": list(islice(self.updates, limit))})
+
+    async def post_inject(self, request):
+        messages = await request.json()
+        self.inject(messages)
+        return web.json_response({"ok": True, "queued": len(self.updates)})
+
+    async def api_setWebhook(self, params):
+        self.stats["setWebhook"] += 1
+        return web.json_response({"ok": True, "result": True})
+
+    async def api_deleteWebhook(self, params):
+        return web.json_response({"ok": True, "result": True})
+
+    async def get_stats(self, request):
+        return web.json_response(dict(self.stats))
+
+
+def make_app(fake):
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", fake.handle)
+    app.router.add_get("/file/bot{token}/{path:.+}", fake.get_file)
+    app.router.add_post("/files", fake.post_file)
+    app.router.add_post("/inject", fake.post_inject)
+    app.router.add_get("/stats", fake.get_stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--flood", type=float, default=0.0)
+    parser.add_argument("--errors", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    fake = FakeTelegram(args.latency, args.flood, args.errors, args.retry_after)
+    web.run_app(make_app(fake), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
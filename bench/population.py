@@ -0,0 +1,56 @@
+"""Синтетические пользователи с правдоподобной историей трат.
+
+Пишет data.json в исходном формате бота (траты списком словарей), так что
+замер включает и переход старых данных на новый формат.
+"""
+import json
+import random
+from datetime import date, datetime, timedelta
+
+DESCS = ["кофе", "обед", "продукты", "такси", "метро", "аптека", "кино", "подарок", "", "", ""]
+
+
+def make_user(rng, today, history_days, reminder_share, due_share):
+    balance = round(rng.uniform(5_000, 100_000), 2)
+    end = today + timedelta(days=rng.randint(5, 60))
+    expenses = []
+    # Активность у всех разная: кто-то пишет каждый день, кто-то раз в неделю
+    activity = rng.uniform(0.1, 1.0)
+    for back in range(history_days, -1, -1):
+        if rng.random() > activity:
+            continue
+        day = (today - timedelta(days=back)).strftime("%d.%m.%Y")
+        for _ in range(rng.randint(1, 4)):
+            amount = round(rng.lognormvariate(6, 0.9))  # медиана ~400 ₽
+            expenses.append({"date": day, "amount": float(amount), "desc": rng.choice(DESCS)})
+    user = {
+        "state": "idle",
+        "balance": balance,
+        "end_date": end.strftime("%d.%m.%Y"),
+        "expenses": expenses,
+    }
+    roll = rng.random()
+    if roll < due_share:
+        # Напоминание на текущую минуту — уйдёт сразу после запуска бота
+        user["reminder"] = datetime.now().strftime("%H:%M")
+    elif roll < due_share + reminder_share:
+        user["reminder"] = f"{rng.randint(7, 22):02d}:{rng.choice([0, 15, 30, 45]):02d}"
+    return user
+
+
+def generate(users, history_days=90, reminder_share=0.3, due_share=0.0, seed=1):
+    rng = random.Random(seed)
+    today = date.today()
+    for i in range(users):
+        yield str(100_000 + i), make_user(rng, today, history_days, reminder_share, due_share)
+
+
+def write_data(path, users, history_days=90, reminder_share=0.3, due_share=0.0, seed=1):
+    """Пишет data.json потоково, не собирая всех пользователей в памяти"""
+    with open(path, "w") as f:
+        f.write("{")
+        for n, (uid, user) in enumerate(generate(users, history_days, reminder_share, due_share, seed)):
+            if n:
+                f.write(",")
+            f.write(f"{json.dumps(uid)}:{json.dumps(user, ensure_ascii=False)}")
+        f.write("}")
@@ -0,0 +1,216 @@
+"""Нагрузочный прогон bot.py против фейкового Telegram API.
+
+    python bench/run.py --users 10000 --messages 20000 --latency 0.05
+    python bench/run.py --users 100000 --storage sqlite --compare bench/results/<прошлый>.json
+
+Генерирует пользователей, поднимает bench/fake_api.py отдельным процессом,
+скармливает боту сценарии через getUpdates и меряет пропускную способность,
+задержку handle_message (p50/p95/p99), время работы с хранилищем и пиковую
+память. Результат пишется в bench/results/<коммит>-<время>.json.
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+import aiohttp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from population import DESCS, write_data  # noqa: E402
+
+# Сценарии: последовательности сообщений одного чата
+MIXES = {
+    "default": {"start": 5, "expense": 40, "quick": 20, "history": 15, "budget": 15, "reminder": 5},
+    "read": {"history": 45, "budget": 45, "expense": 10},
+    "write": {"expense": 50, "quick": 45, "start": 5},
+}
+
+
+def script(name, rng):
+    if name == "start":
+        end = (datetime.now() + timedelta(days=rng.randint(5, 60))).strftime("%d.%m.%Y")
+        return ["/start", str(rng.randint(5_000, 100_000)), end]
+    if name == "expense":
+        return ["💸 Трата", f"{rng.randint(50, 3000)} {rng.choice(DESCS)}".strip()]
+    if name == "quick":
+        sign = "+" if rng.random() < 0.1 else ""
+        return [f"{sign}{rng.randint(50, 3000)} {rng.choice(DESCS)}".strip()]
+    if name == "history":
+        return ["📋 История"]
+    if name == "budget":
+        return ["📊 Мой бюджет"]
+    if name == "reminder":
+        return ["⏰ Напоминание", f"{rng.randint(7, 22):02d}:{rng.choice([0, 30]):02d}"]
+    raise ValueError(name)
+
+
+def traffic(uids, messages, mix, seed):
+    rng = random.Random(seed)
+    names, weights = zip(*MIXES[mix].items())
+    out = []
+    while len(out) < messages:
+        chat_id = int(rng.choice(uids))
+        for text in script(rng.choices(names, weights)[0], rng):
+            out.append({"chat": {"id": chat_id}, "text": text})
+    return out[:messages]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def timed(fn, bucket):
+    def wrapper(*args, **kwargs):
+        t = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            bucket.append(time.perf_counter() - t)
+    return wrapper
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+async def drive(bot, fake_url, updates, timeout):
+    latencies = []
+    handle = bot.handle_message
+
+    async def measured(session, message):
+        t = time.perf_counter()
+        try:
+            await handle(session, message)
+        finally:
+            latencies.append(time.perf_counter() - t)
+
+    bot.handle_message = measured
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{fake_url}/inject", json=updates) as r:
+            await r.json()
+    started = time.perf_counter()
+    runner = asyncio.create_task(bot.run())
+    deadline = started + timeout
+    while len(latencies) < len(updates) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    runner.cancel()
+    try:
+        await runner
+    except asyncio.CancelledError:
+        pass
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{fake_url}/stats") as r:
+            api_stats = await r.json()
+    return latencies, elapsed, api_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--history-days", type=int, default=90)
+    parser.add_argument("--due-reminders", type=float, default=0.02,
+                        help="доля пользователей, чьё напоминание приходится на момент запуска")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="default")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка фейкового API, секунд")
+    parser.add_argument("--send-rate", type=float,
+                        help="лимит отправки бота, сообщений/с (по умолчанию как в Telegram)")
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--out", default=os.path.join(HERE, "results"))
+    parser.add_argument("--compare", help="прошлый результат для сравнения")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="budget-bench-")
+    t = time.perf_counter()
+    write_data(os.path.join(workdir, "data.json"), args.users, args.history_days,
+               due_share=args.due_reminders, seed=args.seed)
+    generate_s = time.perf_counter() - t
+    data_bytes = os.path.getsize(os.path.join(workdir, "data.json"))
+
+    fake_url = f"http://127.0.0.1:{args.port}"
+    fake = subprocess.Popen([sys.executable, os.path.join(HERE, "fake_api.py"),
+                             "--port", str(args.port), "--latency", str(args.latency)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+
+    # Настройки бот читает при импорте
+    os.environ.update({"API_URL": fake_url, "BOT_TOKEN": "bench", "STORAGE": args.storage})
+    if args.send_rate:
+        os.environ.update({"SEND_RATE": str(args.send_rate), "CHAT_RATE": str(args.send_rate)})
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import logging
+    logging.disable(logging.INFO)
+
+    storage_io = []
+    t = time.perf_counter()
+    import bot
+    load_s = time.perf_counter() - t
+    for name in ("write", "read_ledger"):  # обе выполняются в потоке; read_ledger есть только у SqliteStore
+        if hasattr(bot.store, name):
+            setattr(bot.store, name, timed(getattr(bot.store, name), storage_io))
+
+    updates = traffic(list(bot.get_all_users()), args.messages, args.mix, args.seed)
+    try:
+        latencies, elapsed, api_stats = asyncio.run(drive(bot, fake_url, updates, args.timeout))
+    finally:
+        fake.send_signal(signal.SIGINT)
+        fake.wait()
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "params": vars(args),
+        "data_json_bytes": data_bytes,
+        "generate_s": round(generate_s, 3),
+        "load_s": round(load_s, 3),
+        "handled": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_msg_s": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "latency_ms": {f"p{p}": round(percentile(latencies, p) * 1000, 2) for p in (50, 95, 99)},
+        "storage_io_s": round(sum(storage_io), 3),
+        "storage_calls": len(storage_io),
+        "api": api_stats,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"{result['commit']}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Сохранено: {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print(f"\nСравнение с {old['commit']}:")
+        for key in ("throughput_msg_s", "storage_io_s", "peak_rss_mb", "load_s"):
+            print(f"  {key}: {old[key]} -> {result[key]}")
+        for key in result["latency_ms"]:
+            print(f"  latency {key}: {old['latency_ms'][key]} -> {result['latency_ms'][key]} мс")
+
+
+if __name__ == "__main__":
+    main()
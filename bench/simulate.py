@@ -0,0 +1,278 @@
+"""Ускоренный прогон суточных задач бота: месяцы работы за минуты.
+
+    python bench/simulate.py --users 100000 --days 30
+    python bench/simulate.py --users 5000 --days 14 --storage json
+
+Бот работает с подменёнными часами (bot.clock): виртуальное время стоит, пока бот
+занят, и перескакивает к ближайшему пробуждению, когда все задачи ждут часов.
+Сообщения уходят в FakeTelegram из bench/fake_api.py прямо в процессе, без сети.
+По каждым суткам печатается длительность ночного обхода, задержка напоминаний,
+пропущенные и повторные напоминания, сколько байт записано на диск и память.
+Результат пишется в bench/results/sim-<коммит>-<время>.json.
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import asyncio
+import argparse
+import itertools
+import tempfile
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from population import write_data  # noqa: E402
+from fake_api import FakeTelegram  # noqa: E402
+from run import percentile, git_commit, script  # noqa: E402
+
+# Без /start и смены напоминания: так ожидаемые за сутки напоминания известны заранее
+MIX = {"expense": 30, "quick": 35, "budget": 25, "history": 10}
+DAY_START, DAY_END = 8 * 3600, 23 * 3600  # когда пользователи пишут боту, секунд от полуночи
+
+
+class SimClock:
+    """Виртуальные часы: sleep и wait ставят таймер и ждут, пока драйвер не переведёт время"""
+
+    def __init__(self, start):
+        self.t = start
+        self.timers = []   # (срок, номер, future)
+        self.parked = {}   # задача -> (future, событие или None)
+        self.seq = itertools.count()
+
+    def now(self):
+        return self.t
+
+    def today(self):
+        return self.t.date()
+
+    async def sleep(self, seconds):
+        await self.park(seconds, None)
+
+    async def wait(self, event, timeout):
+        if not event.is_set():
+            await self.park(timeout, event)
+
+    async def park(self, seconds, event):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.timers, (self.t + timedelta(seconds=max(seconds, 0)), next(self.seq), future))
+        task = asyncio.current_task()
+        self.parked[task] = (future, event)
+        try:
+            await future
+        finally:
+            self.parked.pop(task, None)
+
+    def idle(self, task):
+        parked = self.parked.get(task)
+        return parked is not None and not parked[0].done()
+
+    def wake_events(self):
+        """Будим тех, чьё событие случилось; возвращаем, сколько разбудили"""
+        woke = 0
+        for future, event in list(self.parked.values()):
+            if event is not None and event.is_set() and not future.done():
+                future.set_result(None)
+                woke += 1
+        return woke
+
+    def next_deadline(self):
+        while self.timers and self.timers[0][2].done():
+            heapq.heappop(self.timers)
+        return self.timers[0][0] if self.timers else None
+
+    def advance(self, t):
+        self.t = max(self.t, t)
+        while self.timers and self.timers[0][0] <= self.t:
+            future = heapq.heappop(self.timers)[2]
+            if not future.done():
+                future.set_result(None)
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def written_bytes():
+    with open("/proc/self/io") as f:
+        for line in f:
+            if line.startswith("wchar:"):
+                return int(line.split()[1])
+    return 0
+
+
+def activity(bot, day, active, rng):
+    """Сообщения активных за сутки пользователей: (время, номер, сообщение)"""
+    uids = [uid for uid, user in bot.get_all_users().items() if "end_date" in user]
+    names, weights = zip(*MIX.items())
+    midnight = datetime.combine(day, datetime.min.time())
+    events = []
+    for uid in rng.sample(uids, int(len(uids) * active)):
+        for _ in range(rng.randint(1, 3)):
+            at = midnight + timedelta(seconds=rng.randint(DAY_START, DAY_END))
+            for text in script(rng.choices(names, weights)[0], rng):
+                events.append((at, len(events), {"chat": {"id": int(uid)}, "text": text}))
+    heapq.heapify(events)
+    return events
+
+
+async def simulate(bot, fake, args):
+    clock = bot.clock = SimClock(datetime.combine(date.today(), datetime.min.time()))
+    end = clock.t + timedelta(days=args.days)
+    rng = random.Random(args.seed)
+
+    reminded = Counter()  # (uid, день) -> сколько напоминаний отправлено
+    lags, savings = [], Counter()
+
+    async def tg(session, method, files=None, **params):
+        result = json.loads((await getattr(fake, f"api_{method}")(params)).body)
+        text = params.get("text", "")
+        if method == "sendMessage" and text.startswith(("⏰ *Напоминание*", "⏰ Период бюджета")):
+            uid = str(params["chat_id"])
+            reminded[uid, clock.today()] += 1
+            due = datetime.combine(clock.today(), datetime.strptime(bot.get_user(uid)["reminder"], "%H:%M").time())
+            lags.append((clock.now() - due).total_seconds())
+        elif text.startswith("🌟"):
+            savings[clock.today()] += 1
+        return result
+
+    bot.tg = tg
+    sweeps = {}
+    check_savings = bot.check_savings
+
+    async def timed_sweep(session):
+        started, virtual = time.perf_counter(), clock.now()
+        await check_savings(session)
+        sweeps[virtual.date()] = {"real_s": round(time.perf_counter() - started, 3),
+                                  "virtual_min": round((clock.now() - virtual).total_seconds() / 60, 1)}
+
+    bot.check_savings = timed_sweep
+
+    dispatcher = bot.Dispatcher(None)
+    sender = bot.outbox.start(None)
+    ignore = {asyncio.current_task(), sender}
+    tasks = [
+        asyncio.create_task(bot.reminder_loop(None)),
+        asyncio.create_task(timed_sweep(None)),
+        asyncio.create_task(bot.store.flush_loop()),
+    ]
+
+    async def settle():
+        # Ждём, пока все задачи бота не встанут на часах (или не закончатся)
+        while True:
+            await asyncio.sleep(0)
+            if bot.outbox.queue.empty() and all(t in ignore or clock.idle(t) for t in asyncio.all_tasks()):
+                return
+            await asyncio.sleep(0.0005)
+
+    days = []
+    day, events, expected = None, [], set()
+    io_mark, rss_start, real_mark = written_bytes(), rss_mb(), time.perf_counter()
+
+    def close_day():
+        sent = {uid for (uid, d) in reminded if d == day}
+        day_lags = lags[:]
+        lags.clear()
+        row = {
+            "day": day.isoformat(),
+            "real_s": round(time.perf_counter() - real_mark, 2),
+            "sweep": sweeps.get(day),
+            "savings_offers": savings[day],
+            "reminders_sent": sum(n for (uid, d), n in reminded.items() if d == day),
+            "reminders_missed": len(expected - sent),
+            "reminders_duplicate": sum(n - 1 for (uid, d), n in reminded.items() if d == day and n > 1),
+            "reminder_lag_s": {f"p{p}": round(percentile(day_lags, p), 1) for p in (50, 99)},
+            "reminder_lag_max_s": round(max(day_lags, default=0), 1),
+            "written_mb": round((written_bytes() - io_mark) / 2**20, 1),
+            "rss_mb": round(rss_mb(), 1),
+        }
+        for key in [k for k in reminded if k[1] == day]:
+            del reminded[key]
+        fake.sent.clear()
+        print(json.dumps(row, ensure_ascii=False))
+        return row
+
+    try:
+        while True:
+            await settle()
+            if clock.wake_events():
+                continue
+            if clock.today() != day:
+                if day is not None:
+                    days.append(close_day())
+                    io_mark, real_mark = written_bytes(), time.perf_counter()
+                if clock.t >= end:
+                    break
+                day = clock.today()
+                events = activity(bot, day, args.active, rng)
+                expected = {uid for uid, user in bot.get_all_users().items()
+                            if user.get("reminder") and "balance" in user and "end_date" in user}
+            midnight = datetime.combine(day + timedelta(days=1), datetime.min.time())
+            candidates = [midnight, clock.next_deadline(), events[0][0] if events else None]
+            clock.advance(min(t for t in candidates if t is not None))
+            while events and events[0][0] <= clock.t:
+                await dispatcher.put(heapq.heappop(events)[2])
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await dispatcher.drain()
+        sender.cancel()
+        await bot.store.commit()
+    return days, rss_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ускоренный прогон суточных задач бота")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--history-days", type=int, default=30)
+    parser.add_argument("--active", type=float, default=0.05, help="доля пользователей, пишущих боту за сутки")
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="sqlite",
+                        help="json переписывает весь файл при каждом сохранении — для 100k пользователей очень долго")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default=os.path.join(HERE, "results"))
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="budget-sim-")
+    write_data(os.path.join(workdir, "data.json"), args.users, args.history_days, seed=args.seed)
+
+    # Настройки бот читает при импорте; лимиты Telegram в симуляции не нужны
+    os.environ.update({"BOT_TOKEN": "sim", "STORAGE": args.storage,
+                       "SEND_RATE": "1e9", "CHAT_RATE": "1e9", "CHAT_BURST": "1000000000"})
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import logging
+    logging.disable(logging.WARNING)
+    import bot
+
+    started = time.perf_counter()
+    days, rss_start = asyncio.run(simulate(bot, FakeTelegram(), args))
+    result = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "params": vars(args),
+        "elapsed_s": round(time.perf_counter() - started, 1),
+        "rss_start_mb": round(rss_start, 1),
+        "rss_growth_mb": round(days[-1]["rss_mb"] - rss_start, 1) if days else 0,
+        "reminders_missed": sum(d["reminders_missed"] for d in days),
+        "reminders_duplicate": sum(d["reminders_duplicate"] for d in days),
+        "days": days,
+    }
+    print(json.dumps({k: v for k, v in result.items() if k != "days"}, ensure_ascii=False, indent=2))
+
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"sim-{result['commit']}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Сохранено: {path}")
+
+
+if __name__ == "__main__":
+    main()
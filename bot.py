@@ -1,110 +1,1500 @@
 import os
+import sys
 import json
+import re
+import sqlite3
 import logging
+import time
+import random
+import signal
+import hmac
+import threading
+import fcntl
+import queue
+import shutil
+import itertools
+import csv
+import io
+import cProfile
+import pstats
 import asyncio
+import contextvars
+import multiprocessing
 import aiohttp
+from aiohttp import web
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
 from datetime import date, datetime, timedelta
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 TOKEN = os.environ.get("BOT_TOKEN")
-API = f"https://api.telegram.org/bot{TOKEN}"
-DATA_FILE = "data.json"
+API_URL = os.environ.get("API_URL", "https://api.telegram.org")  # для тестов — адрес локального фейкового API
+API = f"{API_URL}/bot{TOKEN}"
+STORAGE = os.environ.get("STORAGE", "json")  # json | sqlite
+SHARDS = int(os.environ.get("SHARDS", "1"))  # процессов-обработчиков, см. «Шарды»
+SHARD = os.environ.get("SHARD", "")          # номер шарда — бот сам задаёт его своим воркерам
+ROUTER = SHARDS > 1 and not SHARD            # процесс-приёмник: только раздаёт апдейты воркерам
+SUFFIX = f".{SHARD}" if SHARD else ""        # у каждого шарда свои файлы данных
+DATA_FILE = f"data{SUFFIX}.json"
+_db_base, _db_ext = os.path.splitext(os.environ.get("DB_FILE", "data.db"))
+DB_FILE = f"{_db_base}{SUFFIX}{_db_ext}"
+APPLIED_KEY = "_updates"  # в data.json: update_id, чьи изменения уже в файле (см. UpdateJournal)
 
 WAITING_BALANCE = "waiting_balance"
 WAITING_DATE = "waiting_date"
 WAITING_EXPENSE = "waiting_expense"
 WAITING_REMINDER = "waiting_reminder"
+WAITING_IMPORT = "waiting_import"
 IDLE = "idle"
 
 
+# ── Часы ───────────────────────────────────────────────────
+class Clock:
+    """Текущее время бота. bench/simulate.py подменяет часы, чтобы прогнать месяцы за минуты"""
+
+    def now(self):
+        return datetime.now()
+
+    def today(self):
+        return date.today()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    async def wait(self, event, timeout):
+        """Ждём событие, но не дольше timeout секунд"""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+clock = Clock()
+
+
+# ── Метрики ────────────────────────────────────────────────
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))          # 0 — не поднимать /metrics
+if METRICS_PORT and SHARD:
+    METRICS_PORT += 1 + int(SHARD)  # воркеры шардов — на следующих портах
+PROFILE_SAMPLE = float(os.environ.get("PROFILE_SAMPLE", "0"))    # доля сообщений под профилировщиком
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "500"))  # медленнее — пишем профиль в лог
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metrics:
+    """Счётчики и гистограммы задержек, отдаются в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self.counters = {}    # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счётчики по корзинам..., больше последней, сумма, количество]
+        self.gauges = {}      # имя -> функция без аргументов
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = [0] * (len(BUCKETS) + 3)
+        hist[bisect_left(BUCKETS, seconds)] += 1
+        hist[-2] += seconds
+        hist[-1] += 1
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        def fmt(labels, extra=()):
+            pairs = [f'{k}="{v}"' for k, v in (*labels, *extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        for name in sorted({n for n, _ in self.counters}):
+            lines.append(f"# TYPE {name} counter")
+            lines += [f"{name}{fmt(labels)} {value}" for (n, labels), value in self.counters.items() if n == name]
+        for name in sorted({n for n, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), hist in self.histograms.items():
+                if n != name:
+                    continue
+                total = 0
+                for le, count in zip(BUCKETS, hist):
+                    total += count
+                    lines.append(f"{name}_bucket{fmt(labels, [('le', le)])} {total}")
+                lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {hist[-1]}")
+                lines.append(f"{name}_sum{fmt(labels)} {hist[-2]}")
+                lines.append(f"{name}_count{fmt(labels)} {hist[-1]}")
+        for name, fn in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {fn()}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+async def serve_metrics():
+    async def handler(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", METRICS_PORT).start()
+    logger.info(f"Метрики: http://127.0.0.1:{METRICS_PORT}/metrics")
+    return runner
+
+
+class SlowProfiler:
+    """Выборочно профилирует обработку сообщений; медленные профили пишет в лог"""
+
+    def __init__(self):
+        self.active = False
+
+    @contextmanager
+    def maybe(self, action):
+        if not PROFILE_SAMPLE or self.active or random.random() >= PROFILE_SAMPLE:
+            yield
+            return
+        # Профилируется весь event loop, поэтому одновременно — только один замер
+        self.active = True
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.active = False
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if elapsed_ms >= PROFILE_SLOW_MS:
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(20)
+                logger.warning(f"Медленная обработка {action}: {elapsed_ms:.0f} мс\n{out.getvalue()}")
+
+
+profiler = SlowProfiler()
+
+
 # ── Хранилище ──────────────────────────────────────────────
-def load_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
-    return {}
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", "5"))   # секунд между сбросами
+FLUSH_THRESHOLD = int(os.environ.get("FLUSH_THRESHOLD", "100"))  # столько изменённых — сбросить сразу
+
+
+class Ledger:
+    """Траты пользователя колонками: день (ordinal), сумма и номер описания в таблице описаний.
+    Отсортированы по дню, поэтому выборка за период — два бинарных поиска"""
+
+    __slots__ = ("days", "amounts", "desc_ids", "descs", "desc_index")
+
+    def __init__(self):
+        self.days = array("l")
+        self.amounts = array("d")
+        self.desc_ids = array("l")
+        self.descs = []        # номер -> описание
+        self.desc_index = {}   # описание -> номер
+
+    def __len__(self):
+        return len(self.days)
+
+    def append(self, day, amount, desc=""):
+        desc_id = self.desc_index.get(desc)
+        if desc_id is None:
+            desc_id = self.desc_index[desc] = len(self.descs)
+            self.descs.append(sys.intern(desc))
+        if self.days and day < self.days[-1]:
+            i = bisect_right(self.days, day)
+            self.days.insert(i, day)
+            self.amounts.insert(i, amount)
+            self.desc_ids.insert(i, desc_id)
+        else:
+            self.days.append(day)
+            self.amounts.append(amount)
+            self.desc_ids.append(desc_id)
+
+    def extend(self, rows):
+        """Добавляет пачку трат; если они старше уже записанных — колонки пересортировываются один раз"""
+        start = len(self.days)
+        for day, amount, desc in rows:
+            desc_id = self.desc_index.get(desc)
+            if desc_id is None:
+                desc_id = self.desc_index[desc] = len(self.descs)
+                self.descs.append(sys.intern(desc))
+            self.days.append(day)
+            self.amounts.append(amount)
+            self.desc_ids.append(desc_id)
+        tail = self.days[max(start - 1, 0):]
+        if any(a > b for a, b in zip(tail, tail[1:])):
+            order = sorted(range(len(self.days)), key=self.days.__getitem__)
+            self.days = array("l", (self.days[i] for i in order))
+            self.amounts = array("d", (self.amounts[i] for i in order))
+            self.desc_ids = array("l", (self.desc_ids[i] for i in order))
+
+    def span(self, first, last):
+        return bisect_left(self.days, first), bisect_right(self.days, last)
+
+    def total(self, first, last):
+        i, j = self.span(first, last)
+        return sum(self.amounts[i:j])
+
+    def totals_by_day(self, since):
+        i, _ = self.span(since, since)
+        totals = {}
+        for day, amount in zip(self.days[i:], self.amounts[i:]):
+            totals[day] = totals.get(day, 0) + amount
+        return totals
+
+    def rows(self, i=0, j=None):
+        for k in range(i, len(self.days) if j is None else j):
+            yield self.days[k], self.amounts[k], self.descs[self.desc_ids[k]]
+
+    def pop_before(self, day):
+        """Вынимает траты раньше дня day: [(день, сумма, описание)]"""
+        i = bisect_left(self.days, day)
+        popped = list(self.rows(0, i))
+        del self.days[:i]
+        del self.amounts[:i]
+        del self.desc_ids[:i]
+        # Описания, которые остались только в вынутых тратах, из таблицы убираем
+        used = sorted(set(self.desc_ids))
+        remap = {old: new for new, old in enumerate(used)}
+        self.desc_ids = array("l", (remap[d] for d in self.desc_ids))
+        self.descs = [self.descs[d] for d in used]
+        self.desc_index = {d: i for i, d in enumerate(self.descs)}
+        return popped
+
+    def last(self, n):
+        """Последние n трат, новые первыми: [(день, сумма, описание)]"""
+        start = max(0, len(self.days) - n)
+        return [(self.days[i], self.amounts[i], self.descs[self.desc_ids[i]])
+                for i in range(len(self.days) - 1, start - 1, -1)]
+
+    def to_json(self):
+        # Дни — разницами с предыдущим: в основном 0 и 1, так файл получается заметно меньше
+        deltas = [b - a for a, b in zip(self.days, self.days[1:])]
+        return {
+            "v": 2,
+            "start": self.days[0] if self.days else 0,
+            "days": deltas,
+            "amounts": self.amounts.tolist(),
+            "descs": self.descs,
+            "desc": self.desc_ids.tolist(),
+        }
+
+    @classmethod
+    def from_json(cls, raw):
+        ledger = cls()
+        if isinstance(raw, list):
+            # Старый формат: [{"date": "дд.мм.гггг", "amount": ..., "desc": ...}]
+            for e in raw:
+                ledger.append(datetime.strptime(e["date"], "%d.%m.%Y").toordinal(), e["amount"], e.get("desc", ""))
+            return ledger
+        if not raw.get("amounts"):
+            return ledger
+        day = raw["start"]
+        ledger.days.append(day)
+        for delta in raw["days"]:
+            day += delta
+            ledger.days.append(day)
+        ledger.amounts.extend(raw["amounts"])
+        ledger.desc_ids.extend(raw["desc"])
+        ledger.descs = [sys.intern(d) for d in raw["descs"]]
+        ledger.desc_index = {d: i for i, d in enumerate(ledger.descs)}
+        return ledger
+
+
+def encode(obj):
+    if isinstance(obj, Ledger):
+        return obj.to_json()
+    raise TypeError(f"{type(obj).__name__} не сериализуется в JSON")
 
-def save_data(data):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def load_data():
+    with metrics.timer("storage_seconds", op="load"):
+        if os.path.exists(DATA_FILE):
+            with open(DATA_FILE, "r") as f:
+                return json.load(f)
+        return {}
+
+def load_users(path=DATA_FILE):
+    """Как load_data, но ещё и JSON каждого пользователя ровно как он лежит в файле:
+    первая запись берёт его готовым, а не кодирует всех пользователей заново в event loop"""
+    users, encoded = {}, {}
+    with metrics.timer("storage_seconds", op="load"):
+        if not os.path.exists(path):
+            return users, encoded
+        with open(path, "r") as f:
+            text = f.read()
+        decoder = json.JSONDecoder()
+        space = re.compile(r"\s*").match
+        pos = space(text, text.index("{") + 1).end()
+        while text[pos] != "}":
+            uid, pos = decoder.raw_decode(text, pos)
+            pos = space(text, space(text, pos).end() + 1).end()  # за двоеточием
+            user, end = decoder.raw_decode(text, pos)
+            users[uid], encoded[uid] = user, text[pos:end]
+            pos = space(text, end).end()
+            if text[pos] == ",":
+                pos = space(text, pos + 1).end()
+    return users, encoded
+
+def save_data(data, path=DATA_FILE):
+    # Пишем во временный файл и подменяем атомарно — при падении старый файл цел
+    with metrics.timer("storage_seconds", op="save"):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"), default=encode)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+def write_users(encoded, applied=(), path=DATA_FILE):
+    """То же, что save_data, но из готовых JSON-строк пользователей — выполняется в потоке.
+    applied ложатся в тот же файл: изменения и отметка, какие апдейты их сделали, пишутся вместе"""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write("{")
+        for n, (uid, data) in enumerate(encoded):
+            if n:
+                f.write(",")
+            f.write(f"{json.dumps(uid)}:{data}")
+        if applied:
+            f.write(f"{',' if encoded else ''}{json.dumps(APPLIED_KEY)}:{json.dumps(applied)}")
+        f.write("}")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class UserLocks:
+    """asyncio.Lock на пользователя: обработчик сообщения, напоминание и утренний обход
+    меняют одного пользователя строго по очереди. Лок удаляется, когда он никому не нужен"""
+
+    def __init__(self):
+        self.locks = {}  # uid -> [Lock, сколько задач держат или ждут]
+
+    @asynccontextmanager
+    async def hold(self, uid):
+        uid = str(uid)
+        entry = self.locks.get(uid)
+        if entry is None:
+            entry = self.locks[uid] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[uid]
+
+
+locks = UserLocks()
+
+
+# update_id апдейта, который сейчас обрабатывается в этой задаче (только если его может повторить журнал)
+handling = contextvars.ContextVar("handling", default=None)
+
+
+class GroupCommit:
+    """Запись на диск вне event loop: всё, что изменилось, пока шла прошлая запись,
+    уходит следующей одной пачкой. Наследник даёт take() — забрать изменения (в event loop),
+    write() — записать их (в потоке) и restore() — вернуть пачку в очередь, если запись не удалась"""
+
+    def init_commit(self, applied=()):
+        self.wakeup = asyncio.Event()
+        self.writing = asyncio.Lock()
+        self.saving = None  # запись, которая сейчас идёт в потоке
+        self.waiting = []   # вызвать, когда запишется следующая пачка
+        self.applied = set(applied)  # update_id, чьи изменения записаны или стоят в очереди на запись
+        self.forgotten = 0           # ниже этого update_id applied уже почищен
+
+    def mark_applied(self):
+        """Изменение делает обработчик апдейта: его update_id попадёт в ту же пачку, что и изменение,
+        и повтор апдейта из журнала после падения будет пропущен. Возвращает update_id, если он новый"""
+        update_id = handling.get()
+        if update_id is None or update_id in self.applied:
+            return None
+        self.applied.add(update_id)
+        return update_id
+
+    def forget_updates(self, low):
+        """Апдейты ниже low журнал уже не повторит — помнить их незачем"""
+        if low is None or low <= self.forgotten:
+            return False
+        self.applied = {i for i in self.applied if i >= low}
+        self.forgotten = low
+        return True
+
+    def on_commit(self, callback):
+        """callback вызовется, когда уже сделанные изменения будут на диске, — так апдейт
+        подтверждается Telegram или приёмнику шардов не раньше, чем сохранён его результат"""
+        self.waiting.append(callback)
+        self.wakeup.set()
+
+    async def commit(self):
+        async with self.writing:
+            if self.saving is not None and not self.saving.done():
+                await asyncio.wait({self.saving})  # осталась от отменённой задачи — дожидаемся
+            batch = self.take()
+            done, self.waiting = self.waiting, []
+            if batch is not None:
+                start = time.perf_counter()
+                self.saving = asyncio.get_running_loop().run_in_executor(None, self.write, *batch)
+                self.saving.add_done_callback(partial(self.written, batch))
+                try:
+                    await asyncio.shield(self.saving)
+                except BaseException:
+                    self.waiting[:0] = done  # подтвердим после следующей удачной записи
+                    raise
+                metrics.observe("storage_seconds", time.perf_counter() - start, op="commit")
+            for callback in done:
+                callback()
+
+    def written(self, batch, saving):
+        # Вызывается и тогда, когда commit уже отменили, а запись в потоке доработала
+        if saving.cancelled() or saving.exception() is not None:
+            self.restore(*batch)
+
+    async def flush_loop(self):
+        while True:
+            await clock.wait(self.wakeup, FLUSH_INTERVAL)
+            self.wakeup.clear()
+            try:
+                await self.commit()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка сохранения: {e}")
+
+
+class JsonStore(GroupCommit):
+    """Все пользователи в памяти, изменения копятся и сбрасываются на диск пачкой.
+    Перекодируются только изменившиеся пользователи, сам файл пишется в потоке"""
+
+    def __init__(self):
+        self.users, self.encoded = load_users()  # encoded: uid -> JSON пользователя в последней записи
+        self.encoded.pop(APPLIED_KEY, None)
+        self.dirty = set()
+        self.failed = False  # прошлая запись не удалась — файл нужно переписать, даже если изменений нет
+        self.init_commit(self.users.pop(APPLIED_KEY, ()))
+
+    def get(self, uid):
+        return self.users.get(str(uid), {})
+
+    def set(self, uid, info):
+        uid = str(uid)
+        self.users[uid] = info
+        self.dirty.add(uid)
+        self.mark_applied()
+        if len(self.dirty) >= FLUSH_THRESHOLD:
+            self.wakeup.set()
+
+    def all(self):
+        return self.users
+
+    def cached_ledger(self, uid, user):
+        # Старый список словарей превращается в Ledger и при следующем сохранении пишется в новом формате
+        return Ledger.from_json(user.get("expenses", []))
+
+    def add_expense(self, uid, day, amount, desc):
+        pass  # трата уже в Ledger пользователя, сохранится вместе с ним
+
+    def add_expenses(self, uid, user, rows):
+        self.set(uid, user)  # траты уже в Ledger пользователя
+
+    def archive_expenses(self, uid, user, before):
+        self.set(uid, user)  # Ledger уже без старых трат, файл перепишется целиком
+
+    def clear_expenses(self, uid):
+        self.get(uid).pop("expenses", None)
+        self.mark_applied()
+
+    def take(self):
+        if not self.dirty and not self.failed:
+            return None
+        self.failed = False
+        for uid in self.dirty:
+            self.encoded[uid] = json.dumps(self.users[uid], ensure_ascii=False, separators=(",", ":"), default=encode)
+        self.dirty.clear()
+        return list(self.encoded.items()), sorted(self.applied)
+
+    def write(self, encoded, applied):
+        write_users(encoded, applied)
+
+    def restore(self, encoded, applied):
+        self.failed = True  # encoded уже свежий, осталось только записать
+        self.wakeup.set()
+
+
+class SqliteStore(GroupCommit):
+    """Пользователи — строка в `users`, каждая трата — строка в `expenses`.
+    Изменения копятся в очереди и коммитятся в потоке одной транзакцией на пачку"""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS users (uid TEXT PRIMARY KEY, data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS expenses (
+                uid TEXT NOT NULL, day INTEGER NOT NULL, amount REAL NOT NULL, "desc" TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS expenses_uid_day ON expenses (uid, day);
+            CREATE TABLE IF NOT EXISTS updates (update_id INTEGER PRIMARY KEY);
+        """)
+        self.migrate()
+        self.users = {uid: json.loads(data) for uid, data in self.db.execute("SELECT uid, data FROM users")}
+        self.ops = []    # (sql, параметры, executemany ли) — в порядке вызовов
+        self.dirty = set()
+        self.db_lock = threading.Lock()  # соединение одно на запись и чтение истории, оба — в потоках
+        self.init_commit(i for i, in self.db.execute("SELECT update_id FROM updates"))
+
+    def migrate(self):
+        # Одноразовый перенос из data.json: после успеха файл переименовывается
+        if not os.path.exists(DATA_FILE):
+            return
+        if self.db.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            logger.warning(f"{DATA_FILE} найден, но база уже заполнена — миграция пропущена")
+            return
+        data = load_data()
+        applied = data.pop(APPLIED_KEY, [])
+        with self.db:
+            self.db.executemany("INSERT INTO updates (update_id) VALUES (?)", ((i,) for i in applied))
+            for uid, user in data.items():
+                ledger = Ledger.from_json(user.pop("expenses", []))
+                self.db.executemany(
+                    'INSERT INTO expenses (uid, day, amount, "desc") VALUES (?, ?, ?, ?)',
+                    ((uid, day, amount, ledger.descs[d]) for day, amount, d in zip(ledger.days, ledger.amounts, ledger.desc_ids)))
+                self.db.execute("INSERT INTO users (uid, data) VALUES (?, ?)",
+                                (uid, json.dumps(user, ensure_ascii=False)))
+        os.replace(DATA_FILE, f"{DATA_FILE}.migrated")
+        logger.info(f"Перенесено пользователей из {DATA_FILE}: {len(data)}")
+
+    def get(self, uid):
+        return self.users.get(str(uid), {})
+
+    def set(self, uid, info):
+        uid = str(uid)
+        self.users[uid] = info
+        self.dirty.add(uid)
+        self.mark_applied()
+        self.wakeup.set()
+
+    def mark_applied(self):
+        # Строка в updates коммитится той же транзакцией, что и изменения апдейта
+        update_id = super().mark_applied()
+        if update_id is not None:
+            self.ops.append(("INSERT INTO updates (update_id) VALUES (?)", (update_id,), False))
+
+    def forget_updates(self, low):
+        if super().forget_updates(low):
+            self.ops.append(("DELETE FROM updates WHERE update_id < ?", (low,), False))
+
+    def all(self):
+        return self.users
+
+    def cached_ledger(self, uid, user):
+        return None  # траты в базе, в память их подгружает load_ledger
+
+    async def load_ledger(self, uid):
+        metrics.inc("storage_ledger_loads_total")
+        await self.commit()  # в очереди могут быть траты или удаление этого пользователя
+        return await asyncio.get_running_loop().run_in_executor(None, self.read_ledger, str(uid))
+
+    async def oldest_day(self, uid):
+        await self.commit()
+        return await asyncio.get_running_loop().run_in_executor(None, self.read_oldest_day, str(uid))
+
+    def read_oldest_day(self, uid):
+        with self.db_lock:
+            return self.db.execute("SELECT MIN(day) FROM expenses WHERE uid = ?", (uid,)).fetchone()[0]
+
+    def read_ledger(self, uid):
+        ledger = Ledger()
+        with self.db_lock:
+            rows = self.db.execute('SELECT day, amount, "desc" FROM expenses WHERE uid = ? ORDER BY day, rowid',
+                                   (uid,)).fetchall()
+        for day, amount, desc in rows:
+            ledger.append(day, amount, desc)
+        return ledger
+
+    def add_expense(self, uid, day, amount, desc):
+        self.ops.append(('INSERT INTO expenses (uid, day, amount, "desc") VALUES (?, ?, ?, ?)',
+                         (str(uid), day, amount, desc), False))
+        self.mark_applied()
+        self.wakeup.set()
+
+    def add_expenses(self, uid, user, rows):
+        # Пачка трат и пользователь (баланс, сводки) попадают в одну транзакцию
+        uid = str(uid)
+        self.ops.append(('INSERT INTO expenses (uid, day, amount, "desc") VALUES (?, ?, ?, ?)',
+                         [(uid, day, amount, desc) for day, amount, desc in rows], True))
+        self.set(uid, user)
+
+    def clear_expenses(self, uid):
+        self.ops.append(("DELETE FROM expenses WHERE uid = ?", (str(uid),), False))
+        self.mark_applied()
+        self.wakeup.set()
+
+    def archive_expenses(self, uid, user, before):
+        # Удаление старых трат и новая граница архива — одной транзакцией
+        self.ops.append(("DELETE FROM expenses WHERE uid = ? AND day < ?", (str(uid), before), False))
+        self.set(uid, user)
+
+    def take(self):
+        if not self.ops and not self.dirty:
+            return None
+        # Траты живут в своей таблице, в строку пользователя их не пишем
+        users = [(uid, json.dumps({k: v for k, v in self.users[uid].items() if k != "expenses"}, ensure_ascii=False))
+                 for uid in self.dirty]
+        ops, self.ops = self.ops, []
+        self.dirty.clear()
+        return ops, users
+
+    def write(self, ops, users):
+        with self.db_lock, self.db:
+            for sql, params, many in ops:
+                (self.db.executemany if many else self.db.execute)(sql, params)
+            self.db.executemany("INSERT OR REPLACE INTO users (uid, data) VALUES (?, ?)", users)
+
+    def restore(self, ops, users):
+        # Транзакция откатилась: операции встают перед новыми, пользователи перекодируются заново
+        self.ops[:0] = ops
+        self.dirty.update(uid for uid, _ in users)
+        self.wakeup.set()
+
+
+# Приёмник при SHARDS>1 пользователей не держит: data.json он только раскладывает по шардам
+store = SqliteStore(DB_FILE) if STORAGE == "sqlite" and not ROUTER else JsonStore()
 
 def get_user(uid):
-    return load_data().get(str(uid), {})
+    return store.get(uid)
 
 def set_user(uid, info):
-    data = load_data()
-    data[str(uid)] = info
-    save_data(data)
+    store.set(uid, info)
 
 def get_all_users():
-    return load_data()
+    return store.all()
+
+def loaded_ledger(uid, user):
+    """Траты пользователя, если они уже в памяти (в JsonStore — всегда), иначе None"""
+    expenses = user.get("expenses")
+    if not isinstance(expenses, Ledger):
+        expenses = store.cached_ledger(uid, user)
+        if expenses is not None:
+            user["expenses"] = expenses
+    return expenses
+
+def ledger(uid, user):
+    """Траты пользователя. В SqliteStore их сначала подгружает await load_ledger"""
+    expenses = loaded_ledger(uid, user)
+    if expenses is None:
+        raise RuntimeError(f"Траты {uid} не подгружены")
+    return expenses
+
+async def load_ledger(uid, user):
+    """Траты пользователя; SqliteStore читает их из базы в потоке, не останавливая event loop"""
+    expenses = loaded_ledger(uid, user)
+    if expenses is None:
+        expenses = user["expenses"] = await store.load_ledger(uid)
+    return expenses
+
+def unload(uid, user, loaded):
+    """Траты подгружались только ради одной операции — из памяти их убираем (SqliteStore).
+    В JsonStore траты всегда в памяти, loaded там всегда True"""
+    if not loaded:
+        user.pop("expenses", None)
+
+async def prepare(uid, user):
+    """У старых пользователей нет сводок по дням и месяцам — собираем их из истории один раз"""
+    if not user or (user.get("daily") is not None and user.get("months") is not None):
+        return
+    loaded = loaded_ledger(uid, user) is not None
+    await load_ledger(uid, user)
+    rollup(uid, user)
+    if user.get("months") is None:
+        user["months"] = await rebuild_months(uid, user)
+    set_user(uid, user)
+    unload(uid, user, loaded)
+
+async def oldest_day(uid, user):
+    """Самый ранний день среди свежих трат или None"""
+    expenses = loaded_ledger(uid, user)
+    if expenses is None:
+        return await store.oldest_day(uid)  # SqliteStore: MIN(day) в базе, траты не читаем
+    return expenses.days[0] if len(expenses) else None
+
+def note_day(user, day):
+    """Новая трата могла оказаться самой ранней — сдвигаем границу, по которой compact
+    решает, пора ли в архив. Если границы ещё нет (старые данные), её узнает сам compact"""
+    if "oldest_day" in user and (user["oldest_day"] is None or day < user["oldest_day"]):
+        user["oldest_day"] = day
+
+def add_expense(uid, user, amount, desc):
+    day = clock.today().toordinal()
+    daily = rollup(uid, user)
+    summary = months(uid, user)
+    expenses = loaded_ledger(uid, user)
+    if expenses is not None:  # не подгружены — трата придёт из базы вместе с остальными
+        expenses.append(day, amount, desc)
+    note_day(user, day)
+    store.add_expense(uid, day, amount, desc)
+    daily[str(day)] = round(daily.get(str(day), 0) + amount, 2)
+    add_to_month(summary, month_key(day), amount, 1, {desc: amount})
+    invalidate(uid)
 
 
 # ── Расчёт ─────────────────────────────────────────────────
-def calc_daily(balance, end_date_str):
-    end = datetime.strptime(end_date_str, "%d.%m.%Y").date()
-    today = date.today()
-    days = (end - today).days + 1
-    if days <= 0:
-        return 0, 0
-    return round(balance / days, 2), days
-
 def today_str():
-    return date.today().strftime("%d.%m.%Y")
-
-def spent_today(user):
-    expenses = user.get("expenses", [])
-    today = today_str()
-    return sum(e["amount"] for e in expenses if e["date"] == today)
-
-def spent_week(user):
-    expenses = user.get("expenses", [])
-    week_ago = (date.today() - timedelta(days=6)).strftime("%d.%m.%Y")
-    # простое сравнение строк не работает для дат — конвертируем
-    total = 0
-    for e in expenses:
+    return clock.today().strftime("%d.%m.%Y")
+
+# Суммы трат по дням хранятся прямо у пользователя: user["daily"] = {"<ordinal дня>": сумма}.
+# Так «сегодня», «вчера» и «за 7 дней» — несколько обращений к словарю, а не обход всей истории
+ROLLUP_DAYS = 31
+VERIFY_ROLLUPS = os.environ.get("VERIFY_ROLLUPS") == "1"
+
+def rollup(uid, user):
+    since = clock.today().toordinal() - ROLLUP_DAYS + 1
+    daily = user.get("daily")
+    if daily is None:
+        # Нет сводки (старые данные) — собираем из истории
+        totals = ledger(uid, user).totals_by_day(since)
+        daily = user["daily"] = {str(day): round(total, 2) for day, total in totals.items()}
+    elif len(daily) > ROLLUP_DAYS:
+        for key in [k for k in daily if int(k) < since]:
+            del daily[key]
+    return daily
+
+def spent_between(uid, first, last):
+    daily = rollup(uid, get_user(uid))
+    return sum(daily.get(str(day), 0) for day in range(first, last + 1))
+
+def spent_on(uid, day):
+    return spent_between(uid, day.toordinal(), day.toordinal())
+
+def spent_week(uid):
+    today = clock.today().toordinal()
+    return spent_between(uid, today - 6, today)
+
+class Budget:
+    """Цифры бюджета на сегодня. Считаются один раз и пересчитываются, только когда
+    поменялись баланс, дата окончания, бонус или траты либо наступил новый день"""
+    __slots__ = ("day", "balance", "end_date", "bonus", "end", "days", "daily", "spent", "limit", "remaining")
+
+    def __init__(self, uid, user, day, end=None):
+        self.day = day
+        self.balance = user.get("balance")
+        self.end_date = user.get("end_date")
+        self.bonus = user.get("today_bonus", 0)
+        self.end = self.days = 0
+        self.daily = 0
+        if self.balance is not None and self.end_date is not None:
+            self.end = end or datetime.strptime(self.end_date, "%d.%m.%Y").date().toordinal()
+            self.days = max(self.end - day + 1, 0)
+            self.daily = round(self.balance / self.days, 2) if self.days else 0
+        self.spent = rollup(uid, user).get(str(day), 0)
+        self.limit = self.daily + self.bonus
+        self.remaining = self.limit - self.spent
+
+    def fresh(self, user, day):
+        return (day == self.day and user.get("balance") == self.balance
+                and user.get("end_date") == self.end_date and user.get("today_bonus", 0) == self.bonus)
+
+
+snapshots = {}  # uid -> Budget
+
+
+def budget(uid, user):
+    uid = str(uid)
+    day = clock.today().toordinal()
+    snap = snapshots.get(uid)
+    if snap is None or not snap.fresh(user, day):
+        # Дата та же — не разбираем её заново
+        end = snap.end if snap is not None and snap.end_date == user.get("end_date") else None
+        snap = snapshots[uid] = Budget(uid, user, day, end)
+    return snap
+
+
+def invalidate(uid):
+    """Траты пользователя изменились — при следующем обращении цифры пересчитаются"""
+    snap = snapshots.get(str(uid))
+    if snap is not None:
+        snap.day = None
+
+
+async def verify_rollups():
+    """Сверяем сводки по дням с сырой историей трат; расхождения пересобираем"""
+    since = clock.today().toordinal() - ROLLUP_DAYS + 1
+    broken = 0
+    for uid, user in list(get_all_users().items()):
+        expenses = await load_ledger(uid, user)
+        raw = {str(day): round(total, 2) for day, total in expenses.totals_by_day(since).items()}
+        daily = {k: v for k, v in rollup(uid, user).items() if int(k) >= since and v}
+        if daily != raw:
+            broken += 1
+            logger.warning(f"Сводка трат {uid} расходится с историей — пересобираем")
+            user["daily"] = raw
+            invalidate(uid)
+            set_user(uid, user)
+    logger.info(f"Проверка сводок трат: пользователей {len(get_all_users())}, исправлено {broken}")
+    return broken
+
+
+# ── Архив ──────────────────────────────────────────────────
+# Траты старше RETENTION_DAYS уезжают из пользователя в файлы archive/<uid>/<с>-<по>.tsv
+# (дни — ordinal, «по» не включительно). Файлы только создаются и больше не меняются;
+# у пользователя остаются archived_until (граница) и сводки по месяцам months (см. «Отчёт»)
+RETENTION_DAYS = max(ROLLUP_DAYS, int(os.environ.get("RETENTION_DAYS", "90")))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+COMPACT_SLACK = 30  # архивируем, когда старых трат накопилось на месяц — чтобы не плодить мелкие файлы
+
+
+class Archive:
+    def __init__(self, root):
+        self.root = root
+
+    def write(self, uid, first, last, rows):
+        folder = os.path.join(self.root, str(uid))
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{first}-{last}.tsv")
+        with open(f"{path}.tmp", "w") as f:
+            for day, amount, desc in rows:
+                desc = desc.replace("\t", " ").replace("\n", " ")
+                f.write(f"{day}\t{amount!r}\t{desc}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    def segments(self, uid, until):
+        """Сегменты по порядку от начала до until. Файлы от оборванной архивации
+        (граница у пользователя не успела сохраниться) в цепочку не попадают"""
+        folder = os.path.join(self.root, str(uid))
+        if not until or not os.path.isdir(folder):
+            return []
+        ends = {}
+        for name in os.listdir(folder):
+            if not name.endswith(".tsv"):
+                continue
+            first, last = map(int, name[:-4].split("-"))
+            if last <= until:
+                ends.setdefault(first, []).append(last)
+        chain, pos = [], 0
+        while pos < until and pos in ends:
+            last = max(ends[pos])
+            chain.append(os.path.join(folder, f"{pos}-{last}.tsv"))
+            pos = last
+        return chain
+
+    def read(self, path):
+        with open(path) as f:
+            for line in f:
+                day, amount, desc = line.rstrip("\n").split("\t", 2)
+                yield int(day), float(amount), desc
+
+    def rows(self, uid, until):
+        for path in self.segments(uid, until):
+            yield from self.read(path)
+
+    def last(self, uid, until, n):
+        """Последние n архивных трат, новые первыми"""
+        out = []
+        for path in reversed(self.segments(uid, until)):
+            out.extend(reversed(list(self.read(path))))
+            if len(out) >= n:
+                break
+        return out[:n]
+
+    def clear(self, uid):
+        shutil.rmtree(os.path.join(self.root, str(uid)), ignore_errors=True)
+
+
+archive = Archive(ARCHIVE_DIR)
+
+
+async def compact(uid, user):
+    """Переносит траты старше RETENTION_DAYS в архив; сводки по месяцам в months уже их учитывают.
+    Пора ли, решается по user["oldest_day"] — самой ранней свежей трате, сами траты для этого не читаем"""
+    boundary = clock.today().toordinal() - RETENTION_DAYS + 1
+    if "oldest_day" not in user:
+        user["oldest_day"] = await oldest_day(uid, user)
+        set_user(uid, user)
+    if user["oldest_day"] is None or user["oldest_day"] >= boundary - COMPACT_SLACK:
+        return
+    loaded = loaded_ledger(uid, user) is not None
+    expenses = await load_ledger(uid, user)
+    start = user.get("archived_until", 0)
+    # Сегмент пишется в потоке, а из Ledger траты уходят только после записи: упадём посреди — они останутся свежими
+    rows = list(expenses.rows(0, bisect_left(expenses.days, boundary)))
+    await asyncio.get_running_loop().run_in_executor(None, archive.write, uid, start, boundary, rows)
+    expenses.pop_before(boundary)
+    user["archived_until"] = boundary
+    user["oldest_day"] = expenses.days[0] if len(expenses) else None
+    store.archive_expenses(uid, user, boundary)
+    unload(uid, user, loaded)
+    metrics.inc("expenses_archived_total", len(rows))
+
+async def recent_expenses(uid, user, n):
+    """Последние n трат с учётом архива, новые первыми: [(день, сумма, описание)]"""
+    rows = (await load_ledger(uid, user)).last(n)
+    if len(rows) < n and user.get("archived_until"):
+        rows += await asyncio.get_running_loop().run_in_executor(
+            None, archive.last, uid, user["archived_until"], n - len(rows))
+    return rows
+
+def all_expenses(uid, user):
+    """Вся история по порядку: сначала архив (читается с диска только здесь), потом свежие траты.
+    Свежие траты должны быть уже подгружены (load_ledger)"""
+    yield from archive.rows(uid, user.get("archived_until", 0))
+    yield from ledger(uid, user).rows()
+
+
+# ── Отчёт ──────────────────────────────────────────────────
+# Сводки по месяцам: user["months"] = {"ГГГГ-ММ": {"total": ..., "count": ..., "descs": {описание: сумма}}}.
+# Обновляются при каждой трате; полностью пересобираются только если их нет (старые данные)
+REPORT_MONTHS = 6
+REPORT_TOP = 5
+
+
+def month_key(day):
+    return date.fromordinal(day).strftime("%Y-%m")
+
+def add_to_month(summary, key, total, count, descs):
+    month = summary.setdefault(key, {"total": 0, "count": 0, "descs": {}})
+    month["total"] = round(month["total"] + total, 2)
+    month["count"] += count
+    for desc, amount in descs.items():
+        month["descs"][desc] = round(month["descs"].get(desc, 0) + amount, 2)
+
+def months(uid, user):
+    """Сводки по месяцам; у старых пользователей их один раз собирает prepare"""
+    return user["months"]
+
+def archive_months(uid, until):
+    # Архив читаем строка за строкой — выполняется в потоке
+    summary = {}
+    for day, amount, desc in archive.rows(uid, until):
+        add_to_month(summary, month_key(day), amount, 1, {desc: amount})
+    return summary
+
+async def rebuild_months(uid, user):
+    summary = await asyncio.get_running_loop().run_in_executor(
+        None, archive_months, uid, user.get("archived_until", 0))
+    # Свежие траты отсортированы по дню — режем колонки по границам месяцев и суммируем срезы целиком
+    expenses = ledger(uid, user)
+    i = 0
+    while i < len(expenses):
+        first = date.fromordinal(expenses.days[i]).replace(day=1)
+        next_month = (first + timedelta(days=32)).replace(day=1)
+        j = bisect_left(expenses.days, next_month.toordinal(), i)
+        amounts = expenses.amounts[i:j]
+        descs = {}
+        for desc_id, amount in zip(expenses.desc_ids[i:j], amounts):
+            desc = expenses.descs[desc_id]
+            descs[desc] = descs.get(desc, 0) + amount
+        add_to_month(summary, first.strftime("%Y-%m"), sum(amounts), j - i, descs)
+        i = j
+    return summary
+
+def report_text(uid, user):
+    summary = months(uid, user)
+    today = clock.today()
+    key = today.strftime("%Y-%m")
+    month = summary.get(key, {"total": 0, "count": 0, "descs": {}})
+
+    lines = [f"📈 *Отчёт за {today:%m.%Y}*\n", f"Потрачено: *{month['total']:,.0f} ₽*, трат: {month['count']}"]
+
+    daily_avg = month["total"] / today.day
+    daily = budget(uid, user).daily
+    lines.append(f"В среднем в день: *{daily_avg:,.0f} ₽*"
+                 + (f" (лимит сейчас {daily:,.0f} ₽)" if daily > 0 else ""))
+
+    if daily > 0:
+        # Дни месяца с перерасходом — по суммам за день (они есть за последние ROLLUP_DAYS дней)
+        daily_totals = rollup(uid, user)
+        first = today.replace(day=1).toordinal()
+        over = [d for d in range(first, today.toordinal() + 1) if daily_totals.get(str(d), 0) > daily]
+        if over:
+            days_str = ", ".join(date.fromordinal(d).strftime("%d") for d in over)
+            lines.append(f"⚠️ Дней с перерасходом: *{len(over)}* ({days_str})")
+        else:
+            lines.append("✅ Без перерасхода")
+
+    top = sorted(month["descs"].items(), key=lambda kv: kv[1], reverse=True)[:REPORT_TOP]
+    if top:
+        lines.append("\n*На что ушло больше всего:*")
+        for desc, amount in top:
+            share = amount / month["total"] * 100 if month["total"] else 0
+            lines.append(f"• {desc or 'без описания'} — {amount:,.0f} ₽ ({share:.0f}%)")
+
+    past = sorted(summary)[-REPORT_MONTHS:]
+    if len(past) > 1:
+        lines.append("\n*По месяцам:*")
+        for k in reversed(past):
+            lines.append(f"`{k[5:]}.{k[:4]}` {summary[k]['total']:,.0f} ₽")
+    return "\n".join(lines)
+
+
+# ── Импорт и экспорт ───────────────────────────────────────
+# CSV: дата (ДД.ММ.ГГГГ или ГГГГ-ММ-ДД), сумма, описание. И выгрузка, и загрузка идут потоком —
+# в памяти никогда не лежит весь файл
+IMPORT_BATCH = 500
+IMPORT_MAX_BYTES = 20 * 1024 * 1024  # больше Bot API через getFile не отдаёт
+CSV_CHUNK = 64 * 1024
+
+
+async def export_chunks(uid, user):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    buf.write("\ufeff")  # BOM — чтобы Excel открыл кириллицу
+    writer.writerow(["date", "amount", "description"])
+    for day, amount, desc in all_expenses(uid, user):
+        writer.writerow([date.fromordinal(day).strftime("%d.%m.%Y"), f"{amount:.2f}", desc])
+        if buf.tell() >= CSV_CHUNK:
+            yield buf.getvalue().encode()
+            buf.seek(0)
+            buf.truncate()
+            await asyncio.sleep(0)  # не держим event loop на длинной истории
+    yield buf.getvalue().encode()
+
+
+def parse_row(row):
+    """(день, сумма, описание) или ValueError"""
+    if len(row) < 2:
+        raise ValueError("нужны дата и сумма")
+    raw_date = row[0].strip()
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
         try:
-            edate = datetime.strptime(e["date"], "%d.%m.%Y").date()
-            if edate >= date.today() - timedelta(days=6):
-                total += e["amount"]
-        except Exception:
-            pass
-    return total
+            day = datetime.strptime(raw_date, fmt).date()
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError(f"дата «{raw_date}»")
+    if day > clock.today():
+        raise ValueError(f"дата в будущем «{raw_date}»")
+    # В выписках банков траты бывают со знаком минус
+    amount = abs(float(row[1].replace(",", ".").replace(" ", "").replace("\xa0", "")))
+    if not amount:
+        raise ValueError("сумма 0")
+    desc = row[2].strip() if len(row) > 2 else ""
+    return day.toordinal(), round(amount, 2), desc
+
+
+async def csv_lines(session, file_path):
+    async with session.get(f"{API_URL}/file/bot{TOKEN}/{file_path}") as r:
+        r.raise_for_status()
+        first = True
+        async for line in r.content:
+            text = line.decode("utf-8-sig" if first else "utf-8", errors="replace")
+            first = False
+            yield text
+
+
+class LineFeed:
+    """Строки для csv.reader, который сам читать из сети не умеет: их подкладывают по мере скачивания"""
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+async def csv_rows(session, file_path):
+    """Записи CSV: (номер строки, ячейки). Один csv.reader на весь файл, строки ему отдаются,
+    когда кавычки закрылись, — поле в кавычках с переносом строки остаётся одним полем"""
+    feed = LineFeed()
+    reader = csv.reader(feed)
+    quotes = 0
+    async for line in csv_lines(session, file_path):
+        feed.lines.append(line)
+        quotes += line.count('"')
+        if quotes % 2:
+            continue
+        quotes = 0
+        while feed.lines:
+            yield reader.line_num + 1, next(reader, [])
+    while feed.lines:  # файл кончился посреди кавычек
+        yield reader.line_num + 1, next(reader, [])
+
+
+def commit_batch(uid, user, batch):
+    """Пачка трат — в Ledger, сводки и хранилище (вместе с пользователем) за один раз"""
+    daily = rollup(uid, user)
+    summary = months(uid, user)
+    since = clock.today().toordinal() - ROLLUP_DAYS + 1
+    expenses = loaded_ledger(uid, user)
+    if expenses is not None:
+        expenses.extend(batch)
+    note_day(user, min(day for day, _, _ in batch))
+    for day, amount, desc in batch:
+        if day >= since:
+            daily[str(day)] = round(daily.get(str(day), 0) + amount, 2)
+        add_to_month(summary, month_key(day), amount, 1, {desc: amount})
+    invalidate(uid)
+    store.add_expenses(uid, user, batch)
+
+
+async def import_csv(session, uid, user, document):
+    info = await tg(session, "getFile", file_id=document["file_id"])
+    if not info.get("ok"):
+        return f"❌ Не удалось получить файл: {info.get('description')}"
+
+    # Повторная загрузка своей же выгрузки не должна удваивать траты. Архивный период закрыт:
+    # всё, что раньше archived_until, считаем уже записанным. Свежие траты сверяем по дням —
+    # траты дня берутся из Ledger, когда день встретился впервые, то есть ещё без импортированных
+    expenses = await load_ledger(uid, user)
+    archived_until = user.get("archived_until", 0)
+    existing = {}  # день -> Counter((день, сумма, описание))
+    added, total, today_total, duplicates, archived = 0, 0, 0, 0, 0
+    errors, error_lines = 0, []
+    batch = []
+    today = clock.today().toordinal()
+    async for line_no, row in csv_rows(session, info["result"]["file_path"]):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        try:
+            day, amount, desc = parse_row(row)
+        except ValueError as e:
+            if line_no == 1:
+                continue  # заголовок
+            errors += 1
+            if len(error_lines) < 5:
+                error_lines.append(f"строка {line_no}: {e}")
+            continue
+        if day < archived_until:
+            archived += 1
+            continue
+        same_day = existing.get(day)
+        if same_day is None:
+            same_day = existing[day] = Counter(expenses.rows(*expenses.span(day, day)))
+        if same_day[(day, amount, desc)]:
+            same_day[(day, amount, desc)] -= 1
+            duplicates += 1
+            continue
+        batch.append((day, amount, desc))
+        added += 1
+        total += amount
+        if day == today:
+            today_total += amount
+        if len(batch) >= IMPORT_BATCH:
+            commit_batch(uid, user, batch)
+            batch = []
+            await asyncio.sleep(0)
+    if batch:
+        commit_batch(uid, user, batch)
+
+    # Баланс пересчитываем один раз: прошлые траты уже учтены в балансе, который ввёл пользователь,
+    # а сегодняшние — как если бы их вводили по одной
+    if today_total and "balance" in user:
+        user["balance"] = round(user["balance"] - today_total, 2)
+    user["state"] = IDLE
+    set_user(uid, user)
+
+    lines = [f"📥 *Импорт завершён*\n", f"Добавлено трат: *{added}* на *{total:,.0f} ₽*"]
+    if today_total:
+        lines.append(f"Из них сегодня: {today_total:,.0f} ₽ — списано с баланса")
+    if duplicates:
+        lines.append(f"Пропущено повторов: {duplicates}")
+    if archived:
+        until = date.fromordinal(archived_until).strftime("%d.%m.%Y")
+        lines.append(f"Пропущено трат до {until} — этот период уже в архиве: {archived}")
+    if errors:
+        lines.append(f"Строк с ошибками: {errors}")
+        lines += [f"• {e}" for e in error_lines]
+    if "balance" in user and "end_date" in user:
+        lines.append(f"\n💰 Баланс: {user['balance']:,.2f} ₽\n📆 Лимит в день: *{budget(uid, user).daily:,.2f} ₽*")
+    return "\n".join(lines)
 
 
 # ── Telegram API ───────────────────────────────────────────
-async def tg(session, method, **kwargs):
-    async with session.post(f"{API}/{method}", json=kwargs) as r:
-        return await r.json()
-
-async def send(session, chat_id, text, keyboard=None):
+SEND_RATE = float(os.environ.get("SEND_RATE", "30")) / SHARDS  # сообщений в секунду на весь бот (делим между шардами)
+CHAT_RATE = float(os.environ.get("CHAT_RATE", "1"))       # сообщений в секунду в один чат
+CHAT_BURST = int(os.environ.get("CHAT_BURST", "3"))       # сколько можно отправить в чат подряд без паузы
+SEND_RETRIES = int(os.environ.get("SEND_RETRIES", "5"))
+
+# Полосы приоритета: ответы пользователю идут раньше рассылок
+INTERACTIVE = 0
+BULK = 1
+
+
+async def tg(session, method, files=None, **kwargs):
+    """files: {поле: (имя файла, функция, возвращающая async-генератор байтов)} — отправка потоком"""
+    start = time.perf_counter()
+    code = "exception"
+    try:
+        if files:
+            body = aiohttp.FormData()
+            for key, value in kwargs.items():
+                body.add_field(key, value if isinstance(value, str) else json.dumps(value, ensure_ascii=False))
+            for field, (filename, chunks) in files.items():
+                body.add_field(field, chunks(), filename=filename, content_type="text/csv")
+            request = session.post(f"{API}/{method}", data=body)
+        else:
+            request = session.post(f"{API}/{method}", json=kwargs)
+        async with request as r:
+            result = await r.json()
+        code = "ok" if result.get("ok") else str(result.get("error_code"))
+        return result
+    finally:
+        if method != "getUpdates":  # long polling висит до 30 секунд — его задержка ничего не говорит
+            metrics.observe("tg_request_seconds", time.perf_counter() - start, method=method)
+        metrics.inc("tg_responses_total", method=method, code=code)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Забираем токен (можно в долг) и возвращаем, сколько секунд ждать до своей очереди"""
+        self.refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds):
+        self.refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def idle(self):
+        self.refill()
+        return self.tokens >= self.burst
+
+    async def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Outbox:
+    """Очередь исходящих сообщений с лимитами Telegram, приоритетами и повторами при ошибках"""
+
+    def __init__(self):
+        self.session = None
+        self.queue = asyncio.PriorityQueue()  # (полоса, порядковый номер, method, params, future)
+        self.seq = itertools.count()
+        # Запас всего в одно сообщение и скорость на 10% ниже лимита: иначе за секунду уходит весь запас
+        # и ещё SEND_RATE сверху, а разброс сетевых задержек сбивает отправки в кучу на стороне Telegram
+        self.limit = TokenBucket(SEND_RATE * 0.9, 1)
+        self.chats = {}  # chat_id -> TokenBucket
+        self.deliveries = set()  # идущие отправки — держим ссылки, чтобы задачи не собрал GC
+
+    def start(self, session):
+        self.session = session
+        return asyncio.create_task(self.run())
+
+    async def submit(self, method, params, lane=INTERACTIVE, files=None):
+        """Отправка с ожиданием результата: ответ Bot API или {"ok": False, ...} после всех попыток"""
+        chat_id = params.get("chat_id")
+        if chat_id is not None:
+            bucket = self.chats.get(chat_id)
+            if bucket is None:
+                if len(self.chats) > 10000:
+                    self.chats = {c: b for c, b in self.chats.items() if not b.idle()}
+                bucket = self.chats[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+            # Очередь в чате занимаем сразу — так сообщения одного чата не перемешаются
+            await asyncio.sleep(bucket.reserve())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((lane, next(self.seq), method, params, files, future))
+        return await future
+
+    async def run(self):
+        while True:
+            _, _, method, params, files, future = await self.queue.get()
+            await self.limit.wait()
+            task = asyncio.create_task(self.deliver(method, params, files, future))
+            self.deliveries.add(task)
+            task.add_done_callback(self.deliveries.discard)
+
+    async def deliver(self, method, params, files, future):
+        result = None
+        for attempt in range(SEND_RETRIES):
+            if attempt:
+                await self.limit.wait()
+            try:
+                result = await tg(self.session, method, files=files, **params)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                result = {"ok": False, "description": str(e)}
+                delay = backoff(attempt)
+            else:
+                code = result.get("error_code")
+                if result.get("ok") or (code and code != 429 and code < 500):
+                    break  # доставлено или ошибка, которую повтор не исправит (например, бот заблокирован)
+                if code == 429:
+                    # Флуд-контроль: ждём сколько сказал Telegram, и все остальные тоже
+                    delay = result.get("parameters", {}).get("retry_after", 1)
+                    self.limit.pause(delay)
+                else:
+                    delay = backoff(attempt)
+            if attempt + 1 < SEND_RETRIES:  # после последней попытки не ждём: отправитель держит лок и слот
+                await asyncio.sleep(delay)
+        if not result.get("ok"):
+            logger.error(f"Не доставлено {method} в {params.get('chat_id')}: {result.get('description')}")
+        if not future.done():
+            future.set_result(result)
+
+
+def backoff(attempt):
+    return min(30, 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+outbox = Outbox()
+
+async def send(session, chat_id, text, keyboard=None, lane=INTERACTIVE):
     params = {"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}
     if keyboard is not None:
         params["reply_markup"] = {"keyboard": keyboard, "resize_keyboard": True}
-    await tg(session, "sendMessage", **params)
+    return await outbox.submit("sendMessage", params, lane)
 
 def main_kb():
     return [
         [{"text": "📊 Мой бюджет"}, {"text": "💸 Трата"}],
-        [{"text": "📋 История"}, {"text": "⏰ Напоминание"}],
+        [{"text": "📋 История"}, {"text": "📈 Отчёт"}, {"text": "⏰ Напоминание"}],
         [{"text": "✏️ Обновить баланс"}, {"text": "📅 Изменить дату"}],
+        [{"text": "📤 Экспорт"}, {"text": "📥 Импорт"}],
     ]
 
 
 # ── Обработка сообщений ────────────────────────────────────
+# Метка для метрик: какой кнопкой или в каком состоянии пришло сообщение
+ACTIONS = {
+    "/start": "start",
+    "🎉 Потратить сегодня": "spend_bonus",
+    "📅 Распределить на все дни": "spread_bonus",
+    "✏️ Обновить баланс": "update_balance",
+    "📅 Изменить дату": "change_date",
+    "💸 Трата": "expense",
+    "⏰ Напоминание": "reminder",
+    "📋 История": "history",
+    "📈 Отчёт": "report",
+    "📤 Экспорт": "export",
+    "📥 Импорт": "import",
+    "📊 Мой бюджет": "budget",
+}
+
+def parse_entry(line):
+    """`500 кофе` — трата, `+2000 зарплата` — доход. Возвращает (сумма, описание, доход ли)"""
+    parts = line.split(None, 1)
+    if not parts:
+        raise ValueError
+    raw = parts[0].replace(",", ".")
+    amount = float(raw.lstrip("+"))
+    if amount <= 0:
+        raise ValueError
+    return amount, parts[1] if len(parts) > 1 else "", raw.startswith("+")
+
+
+def limit_tip(uid, user):
+    remaining = budget(uid, user).remaining
+    if remaining < 0:
+        return f"⚠️ Перерасход на *{abs(remaining):,.0f} ₽*! Завтра придётся экономить."
+    return f"✅ Ещё можно потратить сегодня: *{remaining:,.0f} ₽*"
+
+
+async def enter_batch(session, chat_id, uid, user, text):
+    """Несколько строк за раз: верные применяются вместе — одна запись и один пересчёт, ответ — один"""
+    accepted, rejected = [], []
+    for line in filter(None, (line.strip() for line in text.splitlines())):
+        try:
+            accepted.append(parse_entry(line))
+        except ValueError:
+            rejected.append(line.replace("`", "'"))
+
+    if not accepted:
+        await send(session, chat_id,
+            "❌ Не нашла ни одной суммы. Каждая строка — `500 кофе` или `+2000 зарплата`")
+        return
+
+    today = clock.today().toordinal()
+    expenses = [(today, amount, desc) for amount, desc, income in accepted if not income]
+    delta = sum(amount if income else -amount for amount, _, income in accepted)
+    user["balance"] = round(user["balance"] + delta, 2)
+    user["state"] = IDLE
+    if expenses:
+        commit_batch(uid, user, expenses)
+    else:
+        set_user(uid, user)
+
+    lines = [f"📝 *Записала {len(accepted)} из {len(accepted) + len(rejected)}*\n"]
+    for amount, desc, income in accepted:
+        desc_str = f" ({desc})" if desc else ""
+        lines.append(f"💚 +{amount:,.0f} ₽{desc_str}" if income else f"💸 {amount:,.0f} ₽{desc_str}")
+    if rejected:
+        lines.append("\n❌ Не поняла:")
+        lines += [f"• `{line}`" for line in rejected]
+    lines.append(f"\n💰 Остаток: *{user['balance']:,.2f} ₽*")
+    if "end_date" in user:
+        lines.append(f"\n{limit_tip(uid, user)}")
+    await send(session, chat_id, "\n".join(lines), keyboard=main_kb())
+
+
 async def handle_message(session, message):
+    text = message.get("text", "").strip()
+    action = ACTIONS.get(text) or get_user(message["chat"]["id"]).get("state", IDLE)
+    start = time.perf_counter()
+    try:
+        async with locks.hold(message["chat"]["id"]):
+            with profiler.maybe(action):
+                await process_message(session, message)
+    except Exception:
+        metrics.inc("messages_failed_total", action=action)
+        raise
+    finally:
+        metrics.observe("message_seconds", time.perf_counter() - start, action=action)
+
+
+async def process_message(session, message):
     chat_id = message["chat"]["id"]
     uid = str(chat_id)
     text = message.get("text", "").strip()
 
     user = get_user(uid)
     state = user.get("state", IDLE)
+    await prepare(uid, user)
+
+    # Первое сообщение за день — переводим пользователя на новый день, не дожидаясь обхода
+    saved = await rollover(uid, user)
+    if saved > 0:
+        await send_savings(session, uid, user, saved, lane=INTERACTIVE)
 
     # /start
     if text == "/start":
-        set_user(uid, {"state": WAITING_BALANCE})
+        # Архив удаляем в потоке и до сброса пользователя: сам сброс ниже идёт одним шагом, без await
+        await asyncio.get_running_loop().run_in_executor(None, archive.clear, uid)
+        store.clear_expenses(uid)
+        invalidate(uid)
+        reminders.set(uid, None)
+        set_user(uid, {"state": WAITING_BALANCE, "daily": {}, "months": {}, "oldest_day": None})
         await send(session, chat_id,
             "👋 Привет! Я помогу следить за бюджетом.\n\nВведи текущий баланс (число):")
         return
@@ -122,10 +1512,10 @@ async def handle_message(session, message):
             return
         user["today_bonus"] = round(user.get("today_bonus", 0) + bonus, 2)
         set_user(uid, user)
-        daily, _ = calc_daily(user["balance"], user["end_date"])
+        b = budget(uid, user)
         await send(session, chat_id,
-            f"🥳 Окей! Сегодня можно потратить: *{daily + user['today_bonus']:,.0f} ₽*\n"
-            f"_(базовый лимит {daily:,.0f} ₽ + бонус {bonus:,.0f} ₽)_",
+            f"🥳 Окей! Сегодня можно потратить: *{b.limit:,.0f} ₽*\n"
+            f"_(базовый лимит {b.daily:,.0f} ₽ + бонус {bonus:,.0f} ₽)_",
             keyboard=main_kb())
         return
 
@@ -135,10 +1525,9 @@ async def handle_message(session, message):
             return
         user.pop("saved_bonus", None)
         set_user(uid, user)
-        daily, days = calc_daily(user["balance"], user["end_date"])
         await send(session, chat_id,
             f"👍 Сумма распределена на оставшиеся дни.\n"
-            f"📆 Новый лимит в день: *{daily:,.2f} ₽*",
+            f"📆 Новый лимит в день: *{budget(uid, user).daily:,.2f} ₽*",
             keyboard=main_kb())
         return
 
@@ -178,49 +1567,78 @@ async def handle_message(session, message):
         return
 
     if text == "📋 История":
-        if not user.get("expenses"):
+        # Последние 10 трат
+        last = await recent_expenses(uid, user, 10)
+        if not last:
             await send(session, chat_id, "Трат пока нет 🤷‍♀️", keyboard=main_kb())
             return
 
-        today_total = spent_today(user)
-        week_total = spent_week(user)
+        b = budget(uid, user)
+        week_total = spent_week(uid)
 
-        # Последние 10 трат
-        last = user["expenses"][-10:][::-1]
         lines = []
-        for e in last:
-            desc = f" — {e['desc']}" if e.get("desc") else ""
-            lines.append(f"`{e['date']}` {e['amount']:,.0f} ₽{desc}")
+        for day, amount, desc in last:
+            desc = f" — {desc}" if desc else ""
+            lines.append(f"`{date.fromordinal(day).strftime('%d.%m.%Y')}` {amount:,.0f} ₽{desc}")
 
-        daily, _ = calc_daily(user["balance"], user["end_date"]) if "end_date" in user else (0, 0)
-        over = today_total - daily if daily > 0 else 0
+        over = -b.remaining if b.daily > 0 else 0
         over_str = f"\n⚠️ Перерасход сегодня: *{over:,.0f} ₽*" if over > 0 else ""
 
         msg = (
             f"📋 *История трат*\n\n"
-            f"Сегодня: *{today_total:,.0f} ₽*{over_str}\n"
+            f"Сегодня: *{b.spent:,.0f} ₽*{over_str}\n"
             f"За 7 дней: *{week_total:,.0f} ₽*\n\n"
             f"*Последние траты:*\n" + "\n".join(lines)
         )
         await send(session, chat_id, msg, keyboard=main_kb())
         return
 
+    if text == "📤 Экспорт":
+        if not len(await load_ledger(uid, user)) and not user.get("archived_until"):
+            await send(session, chat_id, "Трат пока нет 🤷‍♀️", keyboard=main_kb())
+            return
+        result = await outbox.submit("sendDocument", {
+            "chat_id": chat_id,
+            "caption": "📤 Все траты в CSV: дата, сумма, описание",
+            "reply_markup": {"keyboard": main_kb(), "resize_keyboard": True},
+        }, files={"document": (f"expenses-{clock.today():%Y-%m-%d}.csv", lambda: export_chunks(uid, user))})
+        if not result.get("ok"):
+            await send(session, chat_id, "❌ Не получилось отправить файл, попробуй позже", keyboard=main_kb())
+        return
+
+    if text == "📥 Импорт":
+        if "balance" not in user:
+            await send(session, chat_id, "Сначала настрой бюджет через /start")
+            return
+        user["state"] = WAITING_IMPORT
+        set_user(uid, user)
+        await send(session, chat_id,
+            "Пришли CSV-файл с тратами: `дата,сумма,описание`\n"
+            "Дата — ДД.ММ.ГГГГ или ГГГГ-ММ-ДД. Подойдёт и файл из «📤 Экспорт».\n\n"
+            "Чтобы отменить — напиши `отмена`")
+        return
+
+    if text == "📈 Отчёт":
+        # Без /start сводок нет, а prepare пустых пользователей не трогает — трат тоже нет
+        if not user or not months(uid, user):
+            await send(session, chat_id, "Трат пока нет 🤷‍♀️", keyboard=main_kb())
+            return
+        await send(session, chat_id, report_text(uid, user), keyboard=main_kb())
+        return
+
     if text == "📊 Мой бюджет":
         if "balance" not in user or "end_date" not in user:
             await send(session, chat_id,
                 "У тебя нет данных. Напиши /start чтобы начать.", keyboard=main_kb())
             return
-        daily, days = calc_daily(user["balance"], user["end_date"])
-        today_total = spent_today(user)
+        b = budget(uid, user)
 
-        if days <= 0:
+        if b.days <= 0:
             await send(session, chat_id,
                 "⏰ Период закончился! Обнови баланс и дату.", keyboard=main_kb())
             return
 
-        today_bonus = user.get("today_bonus", 0)
-        effective_daily = daily + today_bonus
-        remaining_today = effective_daily - today_total
+        remaining_today = b.remaining
         if remaining_today < 0:
             status = f"⚠️ *Перерасход на {abs(remaining_today):,.0f} ₽*"
         elif remaining_today == 0:
@@ -231,9 +1649,9 @@ async def handle_message(session, message):
         msg = (
             f"📊 *Твой бюджет*\n\n"
             f"💰 Баланс: {user['balance']:,.2f} ₽\n"
-            f"📅 До: {user['end_date']} ({days} дн.)\n"
-            f"📆 Лимит в день: *{effective_daily:,.2f} ₽*" + (f" _(+{today_bonus:,.0f} ₽ бонус)_" if today_bonus else "") + "\n"
-            f"💸 Потрачено сегодня: {today_total:,.0f} ₽\n"
+            f"📅 До: {user['end_date']} ({b.days} дн.)\n"
+            f"📆 Лимит в день: *{b.limit:,.2f} ₽*" + (f" _(+{b.bonus:,.0f} ₽ бонус)_" if b.bonus else "") + "\n"
+            f"💸 Потрачено сегодня: {b.spent:,.0f} ₽\n"
             f"{status}"
         )
         await send(session, chat_id, msg, keyboard=main_kb())
@@ -261,7 +1679,7 @@ async def handle_message(session, message):
     if state == WAITING_DATE:
         try:
             end = datetime.strptime(text, "%d.%m.%Y").date()
-            if end < date.today():
+            if end < clock.today():
                 await send(session, chat_id, "❌ Дата уже прошла. Введи будущую дату:")
                 return
         except ValueError:
@@ -269,17 +1687,22 @@ async def handle_message(session, message):
             return
         user["end_date"] = text
         user["state"] = IDLE
+        # Бюджет начинается сегодня: вчерашнего дня для подсчёта экономии у него нет
+        user["savings_checked"] = (clock.today() - timedelta(days=1)).strftime("%d.%m.%Y")
         set_user(uid, user)
-        daily, days = calc_daily(user["balance"], text)
+        b = budget(uid, user)
         await send(session, chat_id,
             f"🎉 Всё готово!\n\n"
             f"💰 Баланс: {user['balance']:,.2f} ₽\n"
-            f"📅 До: {text} ({days} дн.)\n"
-            f"📆 Можно тратить в день: *{daily:,.2f} ₽*",
+            f"📅 До: {text} ({b.days} дн.)\n"
+            f"📆 Можно тратить в день: *{b.daily:,.2f} ₽*",
             keyboard=main_kb())
         return
 
     if state == WAITING_EXPENSE:
+        if "\n" in text:
+            await enter_batch(session, chat_id, uid, user, text)
+            return
         parts = text.split(None, 1)
         try:
             amount = float(parts[0].replace(",", "."))
@@ -290,23 +1713,12 @@ async def handle_message(session, message):
             return
 
         desc = parts[1] if len(parts) > 1 else ""
-        expense = {"date": today_str(), "amount": amount, "desc": desc}
-
-        if "expenses" not in user:
-            user["expenses"] = []
-        user["expenses"].append(expense)
+        add_expense(uid, user, amount, desc)
         user["balance"] = round(user["balance"] - amount, 2)
         user["state"] = IDLE
         set_user(uid, user)
 
-        daily, days = calc_daily(user["balance"], user["end_date"]) if "end_date" in user else (0, 0)
-        today_total = spent_today(user)
-        remaining = daily - today_total
-
-        if remaining < 0:
-            tip = f"⚠️ Перерасход на *{abs(remaining):,.0f} ₽*! Завтра придётся экономить."
-        else:
-            tip = f"✅ Ещё можно потратить сегодня: *{remaining:,.0f} ₽*"
+        tip = limit_tip(uid, user)
 
         desc_str = f" ({desc})" if desc else ""
         await send(session, chat_id,
@@ -315,11 +1727,33 @@ async def handle_message(session, message):
             keyboard=main_kb())
         return
 
+    if state == WAITING_IMPORT:
+        document = message.get("document")
+        if text.lower() == "отмена":
+            user["state"] = IDLE
+            set_user(uid, user)
+            await send(session, chat_id, "Импорт отменён.", keyboard=main_kb())
+            return
+        if not document:
+            await send(session, chat_id, "Жду CSV-файл 📎 (или напиши `отмена`)")
+            return
+        if document.get("file_size", 0) > IMPORT_MAX_BYTES:
+            await send(session, chat_id, "❌ Файл больше 20 МБ — раздели его на части")
+            return
+        try:
+            summary = await import_csv(session, uid, user, document)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка импорта для {uid}: {e}")
+            summary = "❌ Не получилось скачать файл, попробуй ещё раз"
+        await send(session, chat_id, summary, keyboard=main_kb())
+        return
+
     if state == WAITING_REMINDER:
         if text.lower() == "отключить":
             user["reminder"] = None
             user["state"] = IDLE
             set_user(uid, user)
+            reminders.set(uid, None)
             await send(session, chat_id, "🔕 Напоминание отключено.", keyboard=main_kb())
             return
         try:
@@ -330,49 +1764,37 @@ async def handle_message(session, message):
         user["reminder"] = text
         user["state"] = IDLE
         set_user(uid, user)
+        reminders.set(uid, text)
         await send(session, chat_id,
             f"⏰ Буду напоминать каждый день в *{text}*!", keyboard=main_kb())
         return
 
     # Умное распознавание: число = трата, +число = доход
     if state == IDLE and "balance" in user and "end_date" in user:
-        parts = text.split(None, 1)
-        raw = parts[0].replace(",", ".")
-        is_income = raw.startswith("+")
-        raw_num = raw.lstrip("+")
+        if "\n" in text:
+            await enter_batch(session, chat_id, uid, user, text)
+            return
         try:
-            amount = float(raw_num)
-            if amount <= 0:
-                raise ValueError
+            amount, desc, is_income = parse_entry(text)
         except ValueError:
             await send(session, chat_id, "Используй кнопки ниже 👇", keyboard=main_kb())
             return
 
-        desc = parts[1] if len(parts) > 1 else ""
         desc_str = f" ({desc})" if desc else ""
 
         if is_income:
             user["balance"] = round(user["balance"] + amount, 2)
             set_user(uid, user)
-            daily, days = calc_daily(user["balance"], user["end_date"])
             await send(session, chat_id,
                 f"💚 Доход: *+{amount:,.0f} ₽*{desc_str}\n"
                 f"💰 Новый баланс: *{user['balance']:,.2f} ₽*\n"
-                f"📆 Новый лимит в день: *{daily:,.2f} ₽*",
+                f"📆 Новый лимит в день: *{budget(uid, user).daily:,.2f} ₽*",
                 keyboard=main_kb())
         else:
-            if "expenses" not in user:
-                user["expenses"] = []
-            user["expenses"].append({"date": today_str(), "amount": amount, "desc": desc})
+            add_expense(uid, user, amount, desc)
             user["balance"] = round(user["balance"] - amount, 2)
             set_user(uid, user)
-            daily, days = calc_daily(user["balance"], user["end_date"])
-            today_total = spent_today(user)
-            remaining = daily - today_total
-            if remaining < 0:
-                tip = f"⚠️ Перерасход на *{abs(remaining):,.0f} ₽*! Завтра придётся экономить."
-            else:
-                tip = f"✅ Ещё можно потратить сегодня: *{remaining:,.0f} ₽*"
+            tip = limit_tip(uid, user)
             await send(session, chat_id,
                 f"💸 Трата: *{amount:,.0f} ₽*{desc_str}\n"
                 f"💰 Остаток: *{user['balance']:,.2f} ₽*\n\n{tip}",
@@ -383,125 +1805,781 @@ async def handle_message(session, message):
 
 
 # ── Напоминания ────────────────────────────────────────────
+SWEEP_FILE = f"sweep{SUFFIX}.json"
+SWEEP_BATCH = int(os.environ.get("SWEEP_BATCH", "20"))         # пользователей проверяем одновременно
+SWEEP_PAUSE = float(os.environ.get("SWEEP_PAUSE", "0.5"))      # секунд между пачками
+
+
+async def rollover(uid, user):
+    """Переводим пользователя на новый день: сбрасываем бонус и считаем вчерашнюю экономию.
+    Возвращает сэкономленную сумму (0, если уже переводили или экономии нет)"""
+    yesterday_day = clock.today() - timedelta(days=1)
+    yesterday = yesterday_day.strftime("%d.%m.%Y")
+
+    if "balance" not in user or "end_date" not in user:
+        return 0
+    if user.get("savings_checked") == yesterday:
+        return 0  # уже проверяли
+    await prepare(uid, user)
+
+    # Считаем сколько потратили вчера
+    spent_yesterday = spent_on(uid, yesterday_day)
+
+    # Считаем каким был лимит вчера (упрощённо: текущий баланс + вчерашние траты)
+    balance_yesterday = user["balance"] + spent_yesterday
+    try:
+        days_yesterday_count = budget(uid, user).end - clock.today().toordinal() + 2
+        if days_yesterday_count <= 0:
+            return 0
+        daily_yesterday = round(balance_yesterday / days_yesterday_count, 2)
+    except Exception:
+        return 0
+
+    saved = round(daily_yesterday - spent_yesterday, 2)
+
+    # Сбрасываем бонус прошлого дня
+    user.pop("today_bonus", None)
+    user["savings_checked"] = yesterday
+    if saved > 0:
+        user["saved_bonus"] = saved
+    set_user(uid, user)
+    await compact(uid, user)
+    return max(saved, 0)
+
+
+async def send_savings(session, uid, user, saved, lane=BULK):
+    savings_kb = [
+        [{"text": "🎉 Потратить сегодня"}],
+        [{"text": "📅 Распределить на все дни"}]
+    ]
+    b = budget(uid, user)
+    daily_new, days_new = b.daily, b.days
+    await send(session, int(uid),
+        f"🌟 *Отличная работа вчера!*\n\n"
+        f"Ты сэкономила *{saved:,.0f} ₽* — это просто супер! 💪\n\n"
+        f"Что делаем с этой суммой?\n"
+        f"• *Потратить сегодня* — дневной лимит вырастет до *{daily_new + saved:,.0f} ₽*\n"
+        f"• *Распределить* — лимит каждого из {days_new} дней станет *{daily_new:,.2f} ₽*",
+        keyboard=savings_kb, lane=lane)
+
+
+def load_sweep():
+    if os.path.exists(SWEEP_FILE):
+        with open(SWEEP_FILE, "r") as f:
+            return json.load(f)
+    return {}
+
+def save_sweep(sweep):
+    tmp = f"{SWEEP_FILE}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(sweep, f)
+    os.replace(tmp, SWEEP_FILE)
+
+
 async def check_savings(session):
-    """Проверяем в начале нового дня — сэкономил ли пользователь вчера"""
-    all_users = get_all_users()
-    yesterday = (date.today() - timedelta(days=1)).strftime("%d.%m.%Y")
-    
-    for uid, user in all_users.items():
-        if "balance" not in user or "end_date" not in user:
-            continue
-        if user.get("savings_checked") == yesterday:
-            continue  # уже проверяли
-
-        # Считаем сколько потратили вчера
-        expenses = user.get("expenses", [])
-        spent_yesterday = sum(e["amount"] for e in expenses if e["date"] == yesterday)
-        
-        # Считаем каким был лимит вчера (упрощённо: текущий баланс + вчерашние траты)
-        balance_yesterday = user["balance"] + spent_yesterday
-        _, days_left = calc_daily(user["balance"], user["end_date"])
-        days_yesterday = days_left + 1
-        if days_yesterday <= 0:
-            continue
-        
-        # Лимит на вчера
-        try:
-            end = datetime.strptime(user["end_date"], "%d.%m.%Y").date()
-            days_yesterday_count = (end - date.today()).days + 2
-            if days_yesterday_count <= 0:
-                continue
-            daily_yesterday = round(balance_yesterday / days_yesterday_count, 2)
-        except Exception:
-            continue
+    """Проверяем в начале нового дня — сэкономил ли пользователь вчера.
+    Те, кто уже написал боту сегодня, переведены на новый день в handle_message и пропускаются.
+    Прогресс пишется в SWEEP_FILE — после перезапуска обход продолжается с того же места"""
+    day = today_str()
+    sweep = load_sweep()
+    if sweep.get("day") != day:
+        sweep = {"day": day, "cursor": None, "done": False}
+    if sweep["done"]:
+        return
 
-        saved = round(daily_yesterday - spent_yesterday, 2)
-        
-        # Сбрасываем бонус прошлого дня
-        user.pop("today_bonus", None)
-        user["savings_checked"] = yesterday
-        
-        if saved > 0:
-            user["saved_bonus"] = saved
-            set_user(uid, user)
-            savings_kb = [
-                [{"text": "🎉 Потратить сегодня"}],
-                [{"text": "📅 Распределить на все дни"}]
-            ]
-            daily_new, days_new = calc_daily(user["balance"], user["end_date"])
-            await send(session, int(uid),
-                f"🌟 *Отличная работа вчера!*\n\n"
-                f"Ты сэкономила *{saved:,.0f} ₽* — это просто супер! 💪\n\n"
-                f"Что делаем с этой суммой?\n"
-                f"• *Потратить сегодня* — дневной лимит вырастет до *{daily_new + saved:,.0f} ₽*\n"
-                f"• *Распределить* — лимит каждого из {days_new} дней станет *{daily_new:,.2f} ₽*",
-                keyboard=savings_kb)
-        else:
-            set_user(uid, user)
+    async def check(uid):
+        async with locks.hold(uid):
+            user = get_user(uid)
+            saved = await rollover(uid, user)
+            if saved > 0:
+                await send_savings(session, uid, user, saved)
+
+    uids = sorted(get_all_users())
+    start = bisect_right(uids, sweep["cursor"]) if sweep["cursor"] is not None else 0
+    started = time.perf_counter()
+    for i in range(start, len(uids), SWEEP_BATCH):
+        batch = uids[i:i + SWEEP_BATCH]
+        with metrics.timer("savings_batch_seconds"):
+            await asyncio.gather(*(check(uid) for uid in batch))
+        metrics.inc("savings_checked_total", len(batch))
+        sweep["cursor"] = batch[-1]
+        save_sweep(sweep)
+        await clock.sleep(SWEEP_PAUSE)
+    sweep["done"] = True
+    save_sweep(sweep)
+    metrics.observe("savings_sweep_seconds", time.perf_counter() - started)
+
+
+REMINDER_GRACE = int(os.environ.get("REMINDER_GRACE", "15"))  # минут: догоняем пропущенные после рестарта
+MINUTES_IN_DAY = 24 * 60
+
+
+def minute_of_day(hhmm):
+    h, m = hhmm.split(":")
+    return int(h) * 60 + int(m)
+
+
+class ReminderScheduler:
+    """Индекс «минута суток -> uid», чтобы не перебирать всех пользователей каждые 30 секунд"""
+
+    def __init__(self):
+        self.slots = {}    # минута -> set(uid)
+        self.minutes = []  # отсортированные минуты, в которых кто-то есть
+        self.by_uid = {}   # uid -> минута
+        self.changed = asyncio.Event()
+        for uid, user in get_all_users().items():
+            if user.get("reminder"):
+                self.set(uid, user["reminder"])
+
+    def set(self, uid, reminder):
+        uid = str(uid)
+        old = self.by_uid.pop(uid, None)
+        if old is not None:
+            self.slots[old].discard(uid)
+            if not self.slots[old]:
+                del self.slots[old]
+                self.minutes.pop(bisect_left(self.minutes, old))
+        if reminder:
+            minute = minute_of_day(reminder)
+            self.by_uid[uid] = minute
+            if minute not in self.slots:
+                self.slots[minute] = set()
+                insort(self.minutes, minute)
+            self.slots[minute].add(uid)
+        self.changed.set()
+
+    def next_due(self, minute):
+        i = bisect_left(self.minutes, minute)
+        return self.minutes[i] if i < len(self.minutes) else None
+
+    def due(self, first, last):
+        i = bisect_left(self.minutes, first)
+        j = bisect_right(self.minutes, last)
+        return [uid for minute in self.minutes[i:j] for uid in self.slots[minute]]
+
+
+reminders = ReminderScheduler()
+
+
+async def send_reminder(session, uid):
+    async with locks.hold(uid):
+        await prepare(uid, get_user(uid))
+        msg = reminder_text(uid)
+    # Результат не проверяем: недоставленное outbox сам пишет в лог
+    if msg:
+        await send(session, int(uid), msg, lane=BULK)
+
+
+def reminder_text(uid):
+    user = get_user(uid)
+    if not user.get("reminder"):
+        reminders.set(uid, None)
+        return None
+    key = f"{today_str()} {user['reminder']}"
+    if user.get("reminded") == key:
+        return None  # уже отправляли сегодня (например, до перезапуска)
+    user["reminded"] = key
+    set_user(uid, user)
+    if "balance" not in user or "end_date" not in user:
+        return None
+    b = budget(uid, user)
+    daily, remaining = b.daily, b.remaining
+    if b.days <= 0:
+        return "⏰ Период бюджета закончился! Не забудь обновить данные."
+    if remaining < 0:
+        return (f"⏰ *Напоминание*\n\n"
+                f"⚠️ Вчера был перерасход на *{abs(remaining):,.0f} ₽*\n"
+                f"📆 Лимит на сегодня: *{daily:,.0f} ₽*")
+    return (f"⏰ *Напоминание*\n\n"
+            f"📆 Лимит на сегодня: *{daily:,.0f} ₽*\n"
+            f"💰 Баланс: {user['balance']:,.0f} ₽")
 
 
 async def reminder_loop(session):
-    sent_today = set()  # uid -> time чтобы не слать дважды
-    last_date = date.today()
+    today = clock.today()
+    now = clock.now()
+    # После перезапуска досылаем то, что должно было уйти за последние REMINDER_GRACE минут
+    cursor = max(0, now.hour * 60 + now.minute - REMINDER_GRACE)
 
     while True:
-        now = datetime.now()
-        current_time = now.strftime("%H:%M")
-
-        # Сброс в полночь
-        if date.today() != last_date:
-            sent_today.clear()
-            last_date = date.today()
-            await check_savings(session)
-
-        all_users = get_all_users()
-        for uid, user in all_users.items():
-            reminder = user.get("reminder")
-            if not reminder:
-                continue
-            key = f"{uid}_{current_time}"
-            if reminder == current_time and key not in sent_today:
-                sent_today.add(key)
-                if "balance" in user and "end_date" in user:
-                    daily, days = calc_daily(user["balance"], user["end_date"])
-                    today_total = spent_today(user)
-                    remaining = daily - today_total
-                    if days <= 0:
-                        msg = "⏰ Период бюджета закончился! Не забудь обновить данные."
-                    elif remaining < 0:
-                        msg = (f"⏰ *Напоминание*\n\n"
-                               f"⚠️ Вчера был перерасход на *{abs(remaining):,.0f} ₽*\n"
-                               f"📆 Лимит на сегодня: *{daily:,.0f} ₽*")
+        now = clock.now()
+
+        # Новый день
+        if now.date() != today:
+            today = now.date()
+            cursor = 0
+            asyncio.create_task(check_savings(session))
+            continue
+
+        minute = now.hour * 60 + now.minute
+        if cursor <= minute:
+            due = reminders.due(cursor, minute)
+            if due:
+                # Отставание: насколько позже минуты самого раннего напоминания проснулся цикл
+                first = reminders.next_due(cursor)
+                metrics.observe("reminder_lag_seconds", (minute - first) * 60 + now.second + now.microsecond / 1e6)
+            with metrics.timer("reminder_iteration_seconds"):
+                await asyncio.gather(*(send_reminder(session, uid) for uid in due))
+            metrics.inc("reminders_sent_total", len(due))
+            cursor = minute + 1
+
+        # Спим до ближайшего напоминания (или до полуночи), просыпаемся раньше, если индекс изменился
+        due = reminders.next_due(cursor)
+        wake_at = datetime.combine(today, datetime.min.time()) + timedelta(
+            minutes=due if due is not None else MINUTES_IN_DAY)
+        reminders.changed.clear()
+        delay = (wake_at - clock.now()).total_seconds()
+        if delay > 0:
+            await clock.wait(reminders.changed, delay)
+
+
+# ── Диспетчер ──────────────────────────────────────────────
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "32"))  # чатов обрабатывается одновременно
+INBOX_SIZE = int(os.environ.get("INBOX_SIZE", "1000"))          # апдейтов в очереди, дальше ждём
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "10"))    # секунд на дообработку при остановке
+
+
+class Dispatcher:
+    """Разные чаты обрабатываются параллельно, сообщения одного чата — строго по порядку"""
+
+    def __init__(self, session, on_done=None):
+        self.session = session
+        self.on_done = on_done  # вызывается с update_id, когда результат обработки записан на диск
+        self.chats = {}  # chat_id -> очередь ещё не обработанных (update_id, сообщение)
+        self.workers = set()
+        self.slots = asyncio.Semaphore(MAX_CONCURRENCY)
+        self.capacity = asyncio.Semaphore(INBOX_SIZE)
+
+    def backlog(self):
+        return sum(len(q) for q in self.chats.values())
+
+    def room(self):
+        return INBOX_SIZE - self.backlog()
+
+    async def put(self, message, update_id=None):
+        # Очередь переполнена — ждём, пока освободится место (а polling не берёт новые апдейты)
+        await self.capacity.acquire()
+        chat_id = message["chat"]["id"]
+        pending = self.chats.get(chat_id)
+        if pending is not None:
+            pending.append((update_id, message))
+            return
+        self.chats[chat_id] = deque([(update_id, message)])
+        task = asyncio.create_task(self.chat_worker(chat_id))
+        self.workers.add(task)
+        task.add_done_callback(self.workers.discard)
+
+    async def chat_worker(self, chat_id):
+        pending = self.chats[chat_id]
+        try:
+            while pending:
+                update_id, message = pending[0]
+                # on_done есть — апдейт может прийти повторно (из журнала или от приёмника после
+                # перезапуска шарда): изменения помечаются его update_id, выполненный пропускается
+                token = handling.set(update_id if self.on_done else None)
+                try:
+                    if not self.on_done or update_id not in store.applied:
+                        async with self.slots:
+                            await handle_message(self.session, message)
                     else:
-                        msg = (f"⏰ *Напоминание*\n\n"
-                               f"📆 Лимит на сегодня: *{daily:,.0f} ₽*\n"
-                               f"💰 Баланс: {user['balance']:,.0f} ₽")
+                        metrics.inc("updates_replayed_total")
+                except Exception as e:
+                    logger.error(f"Ошибка обработки сообщения от {chat_id}: {e}")
+                finally:
+                    handling.reset(token)
+                    pending.popleft()
+                    self.capacity.release()
+                if self.on_done:
+                    store.on_commit(partial(self.on_done, update_id))
+        finally:
+            del self.chats[chat_id]
+
+    async def drain(self):
+        if not self.workers:
+            return
+        logger.info(f"Дообрабатываем очередь: {self.backlog()} сообщений")
+        _, pending = await asyncio.wait(set(self.workers), timeout=DRAIN_TIMEOUT)
+        for t in pending:
+            t.cancel()
+
+
+# ── Polling ────────────────────────────────────────────────
+JOURNAL_FILE = "updates.jsonl"
+OFFSET_FILE = "offset.json"  # прежнее хранилище offset: читается один раз, пока журнала ещё нет
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", "30"))  # секунд держать long polling, если апдейтов нет
+POLL_LIMIT = 100                                          # больше Telegram за раз не отдаёт
+JOURNAL_TRIM = 1000                                       # обработанных строк в журнале, после которых он переписывается
+
+
+class UpdateJournal:
+    """Полученные апдейты сначала дописываются в журнал (с fsync), и только следующий getUpdates
+    с offset=next подтверждает их Telegram. После падения необработанные берутся из журнала.
+    Что апдейт уже выполнен, помнит хранилище: его update_id пишется той же пачкой, что и его
+    изменения (store.applied), — повтор из журнала такой апдейт пропускает"""
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.next = 0                 # offset для следующего getUpdates
+        self.pending = OrderedDict()  # update_id -> строка журнала, результат ещё не записан
+        self.stale = 0                # строк в файле с уже обработанными апдейтами
+        self.low = None               # первый update_id в файле: ниже журнал ничего не повторит
+        self.skip = set()             # обработаны до перехода на журнал (из offset.json)
+        self.file = None
+
+    def load(self):
+        """Читает журнал и переписывает его начисто — без обработанных и недописанных строк"""
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
                     try:
-                        await send(session, int(uid), msg)
-                    except Exception as e:
-                        logger.error(f"Ошибка напоминания для {uid}: {e}")
+                        entry = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Пропущена недописанная строка журнала {self.path}")
+                        continue
+                    if "update_id" in entry:
+                        self.pending[entry["update_id"]] = line.rstrip("\n")
+                        self.next = max(self.next, entry["update_id"] + 1)
+                    else:
+                        self.next = max(self.next, entry["offset"])
+        elif os.path.exists(OFFSET_FILE):
+            with open(OFFSET_FILE, "r") as f:
+                state = json.load(f)
+            self.next, self.skip = state["offset"], set(state["done"])
+        self.rewrite(list(self.pending.items()))
+        return [json.loads(line) for line in self.pending.values()]
+
+    def rewrite(self, entries):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps({"offset": self.next}) + "\n")
+            f.writelines(f"{line}\n" for _, line in entries)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, "a")
+        self.low = entries[0][0] if entries else self.next
+
+    def write(self, lines):
+        self.file.write("".join(f"{line}\n" for line in lines))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    async def append(self, updates):
+        """Дописывает в журнал новые апдейты из ответа getUpdates и возвращает их"""
+        fresh = [u for u in updates if u["update_id"] >= self.next]
+        updates = [u for u in fresh if u["update_id"] not in self.skip]
+        lines = [json.dumps(u, ensure_ascii=False) for u in updates]
+        if lines:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.write, lines)
+            except BaseException:
+                self.stale = JOURNAL_TRIM  # в файле мог остаться обрывок строки — перепишем до следующей записи
+                raise
+        for u, line in zip(updates, lines):
+            self.pending[u["update_id"]] = line
+        if fresh:
+            self.next = fresh[-1]["update_id"] + 1
+        return updates
+
+    def finish(self, update_id):
+        if self.pending.pop(update_id, None) is not None:
+            self.stale += 1
+
+    async def trim(self):
+        if self.stale < JOURNAL_TRIM:
+            return
+        entries = list(self.pending.items())
+        await asyncio.get_running_loop().run_in_executor(None, self.rewrite, entries)
+        self.stale = sum(update_id not in self.pending for update_id, _ in entries)
 
-        await asyncio.sleep(30)
 
+journal = UpdateJournal()
 
-# ── Polling ────────────────────────────────────────────────
-async def polling():
-    offset = 0
-    async with aiohttp.ClientSession() as session:
-        logger.info("Бот запущен!")
-        asyncio.create_task(reminder_loop(session))
+
+async def fetch_updates(session, batches, room):
+    """Забираем следующую пачку, пока предыдущая обрабатывается (в batches — не больше одной впрок).
+    Пачка ложится в журнал до следующего getUpdates: он подтверждает её Telegram"""
+    attempt = 0
+    unhooked = False
+    while True:
+        # Не берём больше, чем влезет в очередь диспетчера
+        limit = max(1, min(POLL_LIMIT, room()))
+        try:
+            if not unhooked:
+                await tg(session, "deleteWebhook")  # getUpdates не работает, пока установлен webhook
+                unhooked = True
+            await journal.trim()
+            result = await tg(session, "getUpdates", offset=journal.next, limit=limit,
+                              timeout=POLL_TIMEOUT, allowed_updates=["message"])
+            updates = await journal.append(result.get("result", [])) if result.get("ok") else []
+        except Exception as e:
+            result = {"ok": False, "description": str(e) or type(e).__name__}
+        if not result.get("ok"):
+            delay = result.get("parameters", {}).get("retry_after") or backoff(attempt)
+            attempt += 1
+            logger.error(f"Ошибка getUpdates: {result.get('description')}, повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+            continue
+        attempt = 0
+        if updates:
+            metrics.inc("updates_received_total", len(updates))
+            await batches.put(updates)
+
+
+async def polling(session, dispatcher):
+    batches = asyncio.Queue(maxsize=1)
+    replay = journal.load()
+    if replay:
+        logger.info(f"Повторяем из журнала апдейты без подтверждения: {len(replay)}")
+        await batches.put(replay)  # уже выполненные пропустит диспетчер (store.applied)
+    metrics.gauge("updates_backlog", lambda: len(journal.pending))  # получены, но ещё не обработаны
+    fetcher = asyncio.create_task(fetch_updates(session, batches, dispatcher.room))
+    try:
+        while True:
+            batch = await batches.get()
+            store.forget_updates(journal.low)
+            for upd in batch:
+                if "message" in upd:
+                    await dispatcher.put(upd["message"], upd["update_id"])
+                else:
+                    journal.finish(upd["update_id"])
+    finally:
+        fetcher.cancel()
+
+
+# ── Webhook ────────────────────────────────────────────────
+MODE = os.environ.get("MODE", "polling")  # polling | webhook
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # публичный адрес, например https://bot.example.com/webhook
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+PORT = int(os.environ.get("PORT", "8080"))
+
+
+class RecentUpdates:
+    """Последние update_id: Telegram повторяет доставку, если не дождался ответа"""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.ids = OrderedDict()
+
+    def seen(self, update_id):
+        if update_id in self.ids:
+            return True
+        self.ids[update_id] = None
+        if len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+        return False
+
+
+async def webhook(session, dispatcher):
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для MODE=webhook нужно указать WEBHOOK_URL")
+    if not WEBHOOK_SECRET:
+        # Без секрета любой, кто знает адрес, может прислать сообщение от имени любого чата
+        raise RuntimeError("Для MODE=webhook нужно указать WEBHOOK_SECRET")
+    recent = RecentUpdates()
+
+    async def receive(request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=403)
+        try:
+            upd = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(upd, dict) or not isinstance(upd.get("update_id"), int):
+            return web.Response(status=400)
+        if not recent.seen(upd["update_id"]) and "message" in upd:
+            # put() только ставит в очередь — ответ Telegram уходит сразу
+            await dispatcher.put(upd["message"], upd["update_id"])
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    result = await tg(session, "setWebhook", url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                      allowed_updates=["message"], max_connections=MAX_CONCURRENCY)
+    if not result.get("ok"):
+        logger.error(f"Не удалось установить webhook: {result.get('description')}")
+    logger.info(f"Webhook слушает порт {PORT}, путь {WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+# ── Шарды ──────────────────────────────────────────────────
+HEARTBEAT = 5                                                       # секунд между сигналами «жив» от воркера
+HEARTBEAT_TIMEOUT = float(os.environ.get("HEARTBEAT_TIMEOUT", "30"))  # молчит дольше — перезапускаем
+SHARDS_FILE = "shards.json"
+
+
+def shard_of(chat_id):
+    return int(chat_id) % SHARDS
+
+
+def split_data():
+    """Первый запуск с SHARDS>1: раскладываем data.json по файлам шардов.
+    Число шардов запоминается — пользователь привязан к своему шарду, менять SHARDS нельзя"""
+    if os.path.exists(SHARDS_FILE):
+        with open(SHARDS_FILE, "r") as f:
+            was = json.load(f)["shards"]
+        if was != SHARDS:
+            raise RuntimeError(f"Данные разложены на {was} шардов, а SHARDS={SHARDS}")
+        return
+    if STORAGE == "sqlite" and os.path.exists(DB_FILE):
+        raise RuntimeError(f"{DB_FILE} нельзя разложить по шардам: запустите с SHARDS=1 и STORAGE=json")
+    users = get_all_users()
+    if users:
+        parts = [{} for _ in range(SHARDS)]
+        for uid, user in users.items():
+            parts[shard_of(uid)][uid] = user
+        for shard, part in enumerate(parts):
+            save_data(part, f"data.{shard}.json")
+        os.replace(DATA_FILE, f"{DATA_FILE}.sharded")
+        logger.info(f"Пользователи из {DATA_FILE} разложены по {SHARDS} шардам")
+        users.clear()
+        store.encoded.clear()  # приёмник пользователей не держит, их JSON из файла тоже
+    with open(SHARDS_FILE, "w") as f:
+        json.dump({"shards": SHARDS}, f)
+
+
+class ShardRouter:
+    """Приёмник: раздаёт апдейты воркерам по chat_id и перезапускает упавших и зависших.
+    Апдейт хранится, пока воркер не подтвердит обработку, — после перезапуска
+    неподтверждённые уходят новому воркеру заново, в прежнем порядке"""
+
+    def __init__(self):
+        self.ctx = multiprocessing.get_context("spawn")  # воркер заново читает настройки и свои данные
+        self.acks = self.ctx.Queue()
+        self.procs = [None] * SHARDS
+        self.inboxes = [None] * SHARDS
+        self.pending = [OrderedDict() for _ in range(SHARDS)]  # update_id -> сообщение
+        self.beats = [None] * SHARDS  # None — воркер ещё загружает данные
+        self.capacity = asyncio.Semaphore(INBOX_SIZE * SHARDS)
+
+    def backlog(self):
+        return sum(len(p) for p in self.pending)
+
+    def room(self):
+        return INBOX_SIZE * SHARDS - self.backlog()
+
+    def alive(self):
+        return sum(p.is_alive() for p in self.procs)
+
+    def low(self):
+        """Ниже этого update_id воркеру ничего не повторят: таких нет ни в pending, ни в журнале"""
+        lows = [next(iter(p)) for p in self.pending if p]
+        if journal.low is not None:
+            lows.append(journal.low)
+        return min(lows, default=None)
+
+    def start(self, shard):
+        inbox = self.ctx.Queue()
+        low = self.low()
+        for update_id, message in self.pending[shard].items():
+            inbox.put((update_id, message, low))
+        os.environ["SHARD"] = str(shard)
+        try:
+            proc = self.ctx.Process(target=shard_main, args=(shard, inbox, self.acks), name=f"shard-{shard}")
+            proc.start()
+        finally:
+            del os.environ["SHARD"]
+        self.procs[shard], self.inboxes[shard] = proc, inbox
+        self.beats[shard] = None
+
+    async def stop(self, shard, timeout):
+        proc, inbox = self.procs[shard], self.inboxes[shard]
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, proc.join, timeout)
+        if proc.is_alive():
+            logger.error(f"Шард {shard} не остановился за {timeout:.0f} с, завершаем принудительно")
+            proc.kill()
+            await loop.run_in_executor(None, proc.join)
+        inbox.cancel_join_thread()  # недочитанное воркером не держит выход: оно есть в pending
+        inbox.close()
+
+    async def put(self, message, update_id):
+        await self.capacity.acquire()
+        shard = shard_of(message["chat"]["id"])
+        self.pending[shard][update_id] = message
+        self.inboxes[shard].put((update_id, message, self.low()))
+
+    async def listen(self):
+        loop = asyncio.get_running_loop()
         while True:
             try:
-                result = await tg(session, "getUpdates", offset=offset, timeout=30)
-                updates = result.get("result", [])
-                for upd in updates:
-                    offset = upd["update_id"] + 1
-                    if "message" in upd:
-                        await handle_message(session, upd["message"])
-            except Exception as e:
-                logger.error(f"Ошибка: {e}")
-                await asyncio.sleep(3)
+                kind, shard, update_id = await loop.run_in_executor(None, self.acks.get, True, 1)
+            except queue.Empty:
+                continue
+            self.beats[shard] = time.monotonic()
+            if kind == "ack" and self.pending[shard].pop(update_id, None) is not None:
+                self.capacity.release()
+                journal.finish(update_id)
+
+    async def supervise(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT)
+            now = time.monotonic()
+            for shard, proc in enumerate(self.procs):
+                beat = self.beats[shard]
+                if not proc.is_alive():
+                    logger.error(f"Шард {shard} упал (код {proc.exitcode})")
+                elif beat is not None and now - beat > HEARTBEAT_TIMEOUT:
+                    logger.error(f"Шард {shard} не отвечает {now - beat:.0f} с")
+                    proc.terminate()
+                else:
+                    continue
+                metrics.inc("shard_restarts_total", shard=shard)
+                await self.stop(shard, HEARTBEAT)
+                logger.info(f"Перезапускаем шард {shard}, в очереди {len(self.pending[shard])} апдейтов")
+                self.start(shard)
+
+    async def shutdown(self):
+        # None в очереди — воркер дообработает всё, что успел получить, сохранит данные и выйдет
+        for inbox in self.inboxes:
+            inbox.put(None)
+        await asyncio.gather(*(self.stop(shard, DRAIN_TIMEOUT + HEARTBEAT) for shard in range(SHARDS)))
+        if self.backlog():
+            logger.warning(f"Остались необработанными: {self.backlog()} апдейтов")
+
+
+class ShardFeed:
+    """Сторона воркера: апдейты своего шарда от приёмника, обратно — подтверждения и «жив»"""
+
+    def __init__(self, shard, inbox, acks):
+        self.shard = shard
+        self.inbox = inbox
+        self.acks = acks
+        self.parent = os.getppid()
+        self.lock = None
+
+    def ack(self, update_id):
+        self.acks.put(("ack", self.shard, update_id))
+
+    async def heartbeat(self):
+        while True:
+            self.acks.put(("beat", self.shard, None))
+            await asyncio.sleep(HEARTBEAT)
+
+    async def own(self):
+        """Напоминания и обход шарда ведёт только один процесс: если прежний воркер
+        ещё не умер до конца, ждём, пока он отпустит файл-замок"""
+        self.lock = open(f"shard{SUFFIX}.lock", "w")
+        while True:
+            try:
+                fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                await asyncio.sleep(1)
+
+    async def receive(self, dispatcher):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                item = await loop.run_in_executor(None, self.inbox.get, True, 1)
+            except queue.Empty:
+                if os.getppid() != self.parent:
+                    logger.error("Приёмник завершился, останавливаем шард")
+                    return
+                continue
+            if item is None:
+                return
+            update_id, message, low = item
+            store.forget_updates(low)
+            await dispatcher.put(message, update_id)
+
+
+def shard_main(shard, inbox, acks):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C ловит приёмник и останавливает воркеры сам
+    asyncio.run(main(ShardFeed(shard, inbox, acks)))
+
+
+# ── Запуск ─────────────────────────────────────────────────
+async def run(feed=None):
+    """Обработка апдейтов. feed задан в воркере шарда: апдейты приходят от приёмника"""
+    async with aiohttp.ClientSession() as session:
+        logger.info(f"Шард {feed.shard} запущен" if feed else "Бот запущен!")
+        if VERIFY_ROLLUPS:
+            await verify_rollups()
+        # В webhook апдейт подтверждается ответом на запрос — отмечать нечего
+        on_done = feed.ack if feed else journal.finish if MODE != "webhook" else None
+        dispatcher = Dispatcher(session, on_done=on_done)
+        sender = outbox.start(session)
+        metrics.gauge("dispatcher_backlog", dispatcher.backlog)
+        metrics.gauge("outbox_queue", outbox.queue.qsize)
+        metrics.gauge("users", lambda: len(get_all_users()))
+        metrics_runner = await serve_metrics() if METRICS_PORT else None
+        tasks = [asyncio.create_task(store.flush_loop())]
+        try:
+            if feed:
+                tasks.append(asyncio.create_task(feed.heartbeat()))
+                await feed.own()
+            tasks += [
+                asyncio.create_task(reminder_loop(session)),
+                asyncio.create_task(check_savings(session)),
+            ]
+            if feed:
+                await feed.receive(dispatcher)
+            elif MODE == "webhook":
+                await webhook(session, dispatcher)
+            else:
+                await polling(session, dispatcher)
+        finally:
+            for t in tasks:
+                t.cancel()
+            await dispatcher.drain()
+            sender.cancel()
+            if metrics_runner:
+                await metrics_runner.cleanup()
+            await store.commit()  # заодно подтверждает дообработанные апдейты
+            logger.info("Данные сохранены, бот остановлен")
+
+
+async def run_router():
+    """SHARDS>1: этот процесс только принимает апдейты, обработка — в воркерах шардов"""
+    split_data()
+    async with aiohttp.ClientSession() as session:
+        logger.info(f"Бот запущен, шардов: {SHARDS}")
+        router = ShardRouter()
+        for shard in range(SHARDS):
+            router.start(shard)
+        metrics.gauge("dispatcher_backlog", router.backlog)
+        metrics.gauge("shards_alive", router.alive)
+        metrics_runner = await serve_metrics() if METRICS_PORT else None
+        listener = asyncio.create_task(router.listen())
+        supervisor = asyncio.create_task(router.supervise())
+        try:
+            if MODE == "webhook":
+                await webhook(session, router)
+            else:
+                await polling(session, router)
+        finally:
+            supervisor.cancel()
+            await router.shutdown()  # подтверждения читаем, пока воркеры не выйдут
+            listener.cancel()
+            if metrics_runner:
+                await metrics_runner.cleanup()
+            logger.info("Бот остановлен")
+
+
+async def main(feed=None):
+    # SIGTERM (остановка деплоя) превращаем в отмену — чтобы сработал финальный flush
+    task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, task.cancel)
+    except (NotImplementedError, RuntimeError):
+        pass
+    try:
+        await (run_router() if ROUTER else run(feed))
+    except asyncio.CancelledError:
+        pass
 
 
 if __name__ == "__main__":
-    asyncio.run(polling())
+    asyncio.run(main())